@@ -5,138 +5,923 @@
 """
 Proxy objects for dealing with MQTT and Domoticz Device objects.
 """
+import collections
+import functools
+import heapq
+import itertools
 import json
-import threading
+import os
+import sys
+import time
+import metrics
 
-def onData(devices, createDevice, rootTopicStr, topicStr, dataStr):
+try:
+    # Faster drop-in for json.loads when installed
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+LinkQualityTopic = 'linkquality'
+XiaomiTopic = 'Basic/Report Attributes/0xFF01'
+ModelTopics = ('Basic/Report Attributes/ModelIdentifier', 'Basic/Read Attributes Response/ModelIdentifier')
+# Domoticz supports Units 1-255 per hardware
+MaxUnit = 255
+# Time source of timers and windows, replaced when replaying captures
+_clock = time.time
+
+_messages = metrics.registry.counter("messages")
+_dropped = metrics.registry.counter("dropped")
+_writes = metrics.registry.counter("writes")
+_registrations = metrics.registry.counter("registrations")
+_repeats = metrics.registry.counter("repeats")
+_duplicates = metrics.registry.counter("duplicates")
+_perfCounter = time.perf_counter
+
+# Endpoint and payload of the Read Attributes request for ModelIdentifier
+DiscoveryTopic = '1/out/Basic/Read Attributes'
+DiscoveryPayload = '["ModelIdentifier"]'
+
+
+class NoFreeUnitError(Exception):
+    pass
+
+
+def onStart(devices):
+    _getDeviceIndex(devices).rebuild()
+
+
+def onDeviceAdded(devices, Unit):
+    _getDeviceIndex(devices).add(Unit)
+
+
+def onDeviceModified(devices, Unit):
+    _getDeviceIndex(devices).add(Unit)
+
+
+def onDeviceRemoved(devices, Unit):
+    index = _getDeviceIndex(devices)
+    cached = index.adapters.get(Unit)
+    if cached is not None:
+        _dirty.pop(cached[1], None)
+        _pending.pop(cached[1], None)
+        deviceID = cached[0].DeviceID
+        _timers.cancel(deviceID)
+        _timers.cancel(('write', deviceID))
+    index.remove(Unit)
+
+
+def onHeartbeat(now=None):
+    global _lastFlush
+
+    if now is None:
+        now = _clock()
+    _timers.run(now)
+    if _dirty and now - _lastFlush >= _writeWindow:
+        flush()
+        _lastFlush = now
+
+
+def onStop():
+    flush()
+
+
+SnapshotVersion = 1
+
+def saveSnapshot(devices, path):
+    """
+    Save state of the cached adapters, pending timers and unknown devices
+    to path, for loadSnapshot() after a restart.
+    """
+    index = _getDeviceIndex(devices)
+    adapters = {}
+    for Unit in index.adapters:
+        a = index.adapters[Unit][1]
+        if a is not None:
+            adapters[a.deviceObj.DeviceID] = [a.__class__.__name__, a.getSnapshot()]
+    timers = []
+    for key in _timers.timers:
+        if isinstance(key, tuple):
+            timers.append([key[0], key[1], _timers.timers[key][0]])
+        else:
+            timers.append(['off', key, _timers.timers[key][0]])
+    hubs = {}
+    for rootTopic in index.hubs:
+        hubs[rootTopic] = list(index.hubs[rootTopic].unknown.devices.items())
+    snapshot = {"version": SnapshotVersion, "time": _clock(), "adapters": adapters, "timers": timers, "hubs": hubs}
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def loadSnapshot(devices, path):
+    """
+    Restore what saveSnapshot() saved, returns False when there was no
+    usable snapshot. Adapters are only restored into devices of the same
+    adapter class and keep the values of their Domoticz device, timers
+    already due fire on the next onHeartbeat().
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        snapshot = _loads(f.read())
+    if snapshot.get("version") != SnapshotVersion:
+        return False
+    index = _getDeviceIndex(devices)
+    restored = {}
+    for deviceID in snapshot["adapters"]:
+        (className, state) = snapshot["adapters"][deviceID]
+        Unit = index.getUnit(deviceID)
+        if Unit is None:
+            continue
+        a = index.getAdapter(Unit)
+        if a is not None and a.__class__.__name__ == className:
+            a.restoreSnapshot(state)
+            restored[deviceID] = a
+    for (kind, deviceID, deadline) in snapshot["timers"]:
+        a = restored.get(deviceID)
+        if a is None:
+            continue
+        if kind == 'off' and isinstance(a, MotionSensor) and a.value == 1:
+            _timers.schedule(deviceID, deadline, a.timerCallback)
+        elif kind == 'write':
+            _timers.schedule((kind, deviceID), deadline, a.update)
+    for rootTopic in snapshot["hubs"]:
+        unknown = index.getHub(rootTopic).unknown
+        for (deviceID, e) in snapshot["hubs"][rootTopic]:
+            if index.getUnit(deviceID) is None:
+                unknown.restore(deviceID, e)
+    return True
+
+
+def onData(devices, createDevice, rootTopicStr, topicStr, data):
+    """
+    Process one MQTT publish. data is the raw payload, bytes or str; it is
+    only decoded by the handler the topic is routed to. rootTopicStr holds
+    the comma separated root topics of all hubs.
+
+    With createDevice None no device is created: returns False when the
+    message would have created one and must be passed again with
+    createDevice, True otherwise.
+    """
+    start = _perfCounter()
+    _messages.inc()
     topic = Topic(rootTopicStr, topicStr)
+    if topic.getRouteKey() not in _consumedTopics or not topic.checkRootTopic():
+        _dropped.inc()
+        return True
     deviceID = topic.getDeviceID()
 
     devProxy = _getDeviceProxy(devices, deviceID)
     if devProxy:
-        devProxy.processData(topic, dataStr)
-    else:
-        _registerDevice(devices, createDevice, deviceID, topic, dataStr)
+        devProxy.processData(topic, data)
+        latency = _latencies.get(devProxy.__class__)
+        if latency is not None:
+            latency.observe(_perfCounter() - start)
+        return True
+    return _registerDevice(devices, createDevice, deviceID, topic, data)
 
         
 def _getDeviceProxy(devices, deviceID):
-    for Unit in devices:
-        if devices[Unit].DeviceID == deviceID:
-            dev = devices[Unit]
-            for i in ProxyObjects:
-                a = i.getAdapter(devices, dev)
-                if a:
-                    return a
+    index = _getDeviceIndex(devices)
+    Unit = index.getUnit(deviceID)
+    if Unit is None:
+        return None
+    return index.getAdapter(Unit)
+
+
+def _createAdapter(devices, dev):
+    for i in ProxyObjects:
+        a = i.getAdapter(devices, dev)
+        if a:
+            return a
     return None
 
 
 def _registerDevice(devices, createDevice, deviceID, topic, data):
-    for i in ProxyObjects:
-        i.registerDevice(devices, createDevice, deviceID, topic, data)
+    unknown = _getDeviceIndex(devices).getHub(topic.getRootTopic()).unknown
+    if topic.getInTopic() not in ModelTopics:
+        unknown.addPending(deviceID)
+        _dropped.inc()
+        return True
+    model = _getSensorModel(topic, data)
+    if model is None:
+        # Failed read, left Pending for the next discovery
+        unknown.addPending(deviceID)
+        _dropped.inc()
+        return True
+    cls = _models.get(model)
+    if cls:
+        if createDevice is None:
+            return False
+        cls.registerDevice(devices, createDevice, deviceID)
+        unknown.discard(deviceID)
+        _registrations.inc()
+    else:
+        unknown.setUnsupported(deviceID)
+        _dropped.inc()
+    return True
+
+
+def getDiscoveryRequests(devices, rootTopicStr, now=None):
+    """
+    (topic, payload) of Read Attributes requests for the ModelIdentifier of
+    devices seen on MQTT which have no Domoticz device yet, each sent to the
+    hub the device was seen on.
+    """
+    if now is None:
+        now = _clock()
+    index = _getDeviceIndex(devices)
+    requests = []
+    for rootTopic in getRootTopics(rootTopicStr):
+        for deviceID in index.getHub(rootTopic).unknown.getDiscoveries(now):
+            requests.append((rootTopic+'/'+deviceID+'/'+DiscoveryTopic, DiscoveryPayload))
+    return requests
+
+
+class UnknownDevices:
+    """
+    Bounded LRU of DeviceIDs publishing without a Domoticz device, either
+    Pending (model not known yet) or Unsupported (model has no adapter).
+
+    Pending devices are queued for discovery: getDiscoveries() hands out at
+    most DiscoveriesPerCall of them per call and asks each one again after
+    DiscoveryRetry seconds, up to DiscoveryAttempts times.
+    """
+    Pending = 0
+    Unsupported = 1
+
+    MaxSize = 1024
+    DiscoveriesPerCall = 2
+    DiscoveryRetry = 10*60
+    DiscoveryAttempts = 3
+
+    def __init__(self):
+        # DeviceID -> [state, next discovery time, discovery attempts]
+        self.devices = collections.OrderedDict()
+        self.queue = collections.deque()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def getState(self, deviceID):
+        e = self.devices.get(deviceID)
+        if e is None:
+            return None
+        return e[0]
+
+    def addPending(self, deviceID):
+        if deviceID in self.devices:
+            self.devices.move_to_end(deviceID)
+            return
+        self._add(deviceID, [UnknownDevices.Pending, 0, 0])
+        self.queue.append(deviceID)
+
+    def setUnsupported(self, deviceID):
+        if deviceID in self.devices:
+            self.devices[deviceID][0] = UnknownDevices.Unsupported
+            self.devices.move_to_end(deviceID)
+        else:
+            self._add(deviceID, [UnknownDevices.Unsupported, 0, 0])
+
+    def discard(self, deviceID):
+        self.devices.pop(deviceID, None)
+
+    def restore(self, deviceID, e):
+        self._add(deviceID, list(e))
+        if e[0] == UnknownDevices.Pending:
+            self.queue.append(deviceID)
+
+    def getDiscoveries(self, now):
+        result = []
+        for i in range(len(self.queue)):
+            if len(result) >= self.DiscoveriesPerCall:
+                break
+            deviceID = self.queue.popleft()
+            e = self.devices.get(deviceID)
+            if e is None or e[0] != UnknownDevices.Pending or e[2] >= self.DiscoveryAttempts:
+                continue
+            if e[1] <= now:
+                result.append(deviceID)
+                e[1] = now + self.DiscoveryRetry
+                e[2] += 1
+            self.queue.append(deviceID)
+        return result
+
+    def _add(self, deviceID, e):
+        self.devices[deviceID] = e
+        if len(self.devices) > self.MaxSize:
+            self.devices.popitem(last=False)
+
+
+class Hub:
+    """
+    State kept per hub, i.e. per root topic. The device lookup is shared by
+    all hubs, DeviceIDs are Zigbee IEEE addresses and unique across them.
+    """
+    def __init__(self, rootTopic):
+        self.rootTopic = rootTopic
+        self.unknown = UnknownDevices()
+
+
+class DeviceIndex:
+    """
+    DeviceID -> Unit lookup for the Domoticz Devices dictionary.
+
+    Built once from Devices and kept current through add()/remove(). Entries
+    are verified on lookup, so devices changed behind our back (or a Devices
+    dictionary of different size) only cost a rebuild, never a wrong answer.
+
+    Also caches one long-lived adapter per Unit. A cached adapter is dropped
+    when its Unit is modified or removed, or when Devices holds a different
+    device object for the Unit.
+
+    Free Units are tracked as well: gaps left by deleted devices are reused
+    lowest first before the Unit after the highest one in use.
+
+    DeviceIDs seen without a Unit are remembered per hub, see getHub().
+    Units are limited to MaxUnit unless devices sets its own MaxUnit.
+    """
+    def __init__(self, devices):
+        self.devices = devices
+        self.maxUnit = getattr(devices, "MaxUnit", MaxUnit)
+        self.adapters = {}
+        self.hubs = {}
+        self.rebuild()
+
+    def rebuild(self):
+        self.units = {}
+        self.deviceIDs = {}
+        for Unit in self.devices:
+            self._index(Unit)
+        self.count = len(self.devices)
+        self.nextUnit = max(self.devices, default=0) + 1
+        self.freeUnits = [u for u in range(1, min(self.nextUnit, self.maxUnit+1)) if u not in self.devices]
+        for Unit in list(self.adapters):
+            if self.devices.get(Unit) is not self.adapters[Unit][0]:
+                del self.adapters[Unit]
+
+    def add(self, Unit):
+        if Unit in self.deviceIDs:
+            self.remove(Unit)
+        if Unit in self.devices:
+            self._index(Unit)
+            self.nextUnit = max(self.nextUnit, Unit+1)
+        self.count = len(self.devices)
+
+    def remove(self, Unit):
+        self.adapters.pop(Unit, None)
+        if Unit not in self.devices and Unit < self.nextUnit:
+            heapq.heappush(self.freeUnits, Unit)
+        deviceID = self.deviceIDs.pop(Unit, None)
+        if deviceID is not None and self.units.get(deviceID) == Unit:
+            del self.units[deviceID]
+            # Another Unit may carry the same DeviceID
+            for u in self.deviceIDs:
+                if self.deviceIDs[u] == deviceID:
+                    self.units[deviceID] = u
+                    break
+        self.count = len(self.devices)
+
+    def getUnit(self, deviceID):
+        if self.count != len(self.devices):
+            self.rebuild()
+        Unit = self.units.get(deviceID)
+        if Unit is None:
+            return None
+        dev = self.devices.get(Unit)
+        if dev is None or dev.DeviceID != deviceID:
+            self.rebuild()
+            Unit = self.units.get(deviceID)
+        return Unit
+
+    def allocateUnit(self):
+        if self.count != len(self.devices):
+            self.rebuild()
+        while self.freeUnits:
+            Unit = heapq.heappop(self.freeUnits)
+            if Unit not in self.devices:
+                return Unit
+        if self.nextUnit > self.maxUnit:
+            raise NoFreeUnitError("All {0} Domoticz Units are in use".format(self.maxUnit))
+        Unit = self.nextUnit
+        self.nextUnit += 1
+        return Unit
+
+    def getHub(self, rootTopic):
+        hub = self.hubs.get(rootTopic)
+        if hub is None:
+            hub = self.hubs[rootTopic] = Hub(rootTopic)
+        return hub
+
+    def getAdapter(self, Unit):
+        dev = self.devices[Unit]
+        cached = self.adapters.get(Unit)
+        if cached is not None and cached[0] is dev:
+            return cached[1]
+        a = _createAdapter(self.devices, dev)
+        self.adapters[Unit] = (dev, a)
+        return a
+
+    def _index(self, Unit):
+        deviceID = self.devices[Unit].DeviceID
+        for hub in self.hubs.values():
+            hub.unknown.discard(deviceID)
+        self.deviceIDs[Unit] = deviceID
+        if deviceID not in self.units or Unit < self.units[deviceID]:
+            self.units[deviceID] = Unit
+
+
+_deviceIndex = None
+
+def _getDeviceIndex(devices):
+    global _deviceIndex
+
+    if _deviceIndex is None or _deviceIndex.devices is not devices:
+        _deviceIndex = DeviceIndex(devices)
+    return _deviceIndex
 
 
 class Topic:
     def __init__(self, rootTopic, topic):
         self.rootTopic = rootTopic
-        self.topic = topic.split('/')
-        
+        (self.root, self.deviceID, self.topic, self.inTopic) = _parseTopic(topic)
+
     def checkRootTopic(self):
-        return len(self.topic) > 0 and self.topic[0] == self.rootTopic
+        return self.root in getRootTopics(self.rootTopic)
 
     def getExpectedRootTopic(self):
         return self.rootTopic
 
     def getRootTopic(self):
-        if len(self.topic) > 0:
-            return self.topic[0]
-        return ""
-    
+        return self.root
+
     def getDeviceID(self):
-        if len(self.topic) >= 2:
-            return self.topic[1]
-        return None
-    
+        return self.deviceID
+
     def getTopic(self):
-        if len(self.topic) >= 3:
-            return self.asString(self.topic[2:])
-        return None
+        return self.topic
 
     def getInTopic(self):
-        if len(self.topic) >= 5 and self.topic[3] == 'in':
-            return self.asString(self.topic[4:])
-        return None
+        return self.inTopic
 
-    def asString(self, topic):
-        if topic is None:
-            return None
-        return '/'.join(topic)
+    def getRouteKey(self):
+        if self.inTopic is not None:
+            return self.inTopic
+        return self.topic
+
+
+@functools.lru_cache(maxsize=16)
+def getRootTopics(rootTopicStr):
+    """
+    Tuple of the root topics in comma separated rootTopicStr.
+    """
+    return tuple([sys.intern(t.strip()) for t in rootTopicStr.split(',') if t.strip()])
+
+
+def _parseTopic(topicStr):
+    """
+    Split topic string into (root, deviceID, topic, inTopic).
+
+    Root and DeviceID are split off on every call, only the part after the
+    DeviceID is parsed through the _parseSuffix() cache.
+    """
+    t = topicStr.split('/', 2)
+    if len(t) < 3:
+        return (t[0], t[1] if len(t) == 2 else None, None, None)
+    return (t[0], t[1]) + _parseSuffix(t[2])
+
+
+@functools.lru_cache(maxsize=256)
+def _parseSuffix(topic):
+    """
+    Split the topic after the DeviceID into (topic, inTopic).
+
+    All sensors share a small fixed set of these, so the result is memoized
+    whatever the fleet size and the strings are interned.
+    """
+    t = topic.split('/')
+    inTopic = None
+    if len(t) >= 3 and t[1] == 'in':
+        inTopic = sys.intern('/'.join(t[2:]))
+    return (sys.intern(topic), inTopic)
+
+
+# Write coalescing: with a non-zero window adapters which do not ask for
+# ImmediateWrite only mark themselves dirty and are written by flush()
+_writeWindow = 0
+_dirty = {}
+_lastFlush = 0
+
+def setWriteWindow(seconds):
+    global _writeWindow
+
+    _writeWindow = seconds
+    if not seconds:
+        flush()
+
+def flush():
+    global _dirty
+
+    dirty = _dirty
+    _dirty = {}
+    for a in dirty:
+        a.update()
+    flushPending()
+
+
+# Deferred writes: adapters which would write right away only mark
+# themselves pending, flushPending() writes them. Lets messages be processed
+# on another thread while Domoticz devices are only written by the caller
+# of flushPending()
+_deferWrites = False
+_pending = {}
+
+def setDeferWrites(enabled):
+    global _deferWrites
+
+    _deferWrites = enabled
+
+def flushPending():
+    global _pending
+
+    pending = _pending
+    _pending = {}
+    for a in pending:
+        a.update()
 
 
-def _getNextUnitId(devices):
-    umax = 0
-    for i in devices:
-        umax = max(umax, devices[i].Unit)
-    return umax+1
+# Measurement -> smallest change of a value which is written to Domoticz
+_deadbands = {}
+# Seconds after which unchanged measurements are written anyway, 0 for never
+_maxSilence = 30*60
+
+def setDeadband(measurement, value):
+    _deadbands[measurement] = float(value)
+
+def setMaxSilence(seconds):
+    global _maxSilence
+
+    _maxSilence = float(seconds)
+
+# DeviceID -> minimum seconds between writes, overrides MinWriteInterval
+_minWriteIntervals = {}
+
+def setMinWriteInterval(target, seconds):
+    """
+    Set the minimum write interval of all adapters (target None), of an
+    adapter class (target is its name) or of a single DeviceID.
+    """
+    seconds = float(seconds)
+    if target is None:
+        XiaomiSensorWithBatteryAndLinkquality.MinWriteInterval = seconds
+        return
+    for cls in ProxyObjects:
+        if cls.__name__.lower() == target.lower():
+            cls.MinWriteInterval = seconds
+            return
+    _minWriteIntervals[target] = seconds
+
+# Seconds a payload repeated on the same topic of a device is skipped unparsed
+_repeatWindow = 10
+# Seconds a value applied via one topic is ignored when it arrives unchanged
+# via another one, e.g. OnOff followed by the same value in 0xFF01
+_duplicateWindow = 5
+
+def setRepeatWindow(seconds):
+    global _repeatWindow
+
+    _repeatWindow = float(seconds)
+
+def setDuplicateWindow(seconds):
+    global _duplicateWindow
+
+    _duplicateWindow = float(seconds)
+
+# Measurement -> aggregation mode, see Aggregator
+_aggregation = {}
+
+def setAggregation(measurement, mode):
+    """
+    Aggregate readings of a measurement between writes, measurement None
+    sets the mode of all measurements.
+    """
+    mode = mode.lower()
+    if mode not in Aggregator.Modes:
+        raise ValueError("Unknown aggregation mode: "+mode)
+    if measurement is None:
+        for cls in ProxyObjects:
+            for m in cls.Measurements:
+                _aggregation[m] = mode
+        return
+    _aggregation[measurement.lower()] = mode
+
+# Options accepted by configure(): name -> setter taking the value string.
+# Options in QualifiedOptions also accept "name.qualifier", the setter then
+# takes the qualifier (None without) and the value string.
+Options = {
+    "temperature": lambda v: setDeadband("temperature", v),
+    "humidity": lambda v: setDeadband("humidity", v),
+    "pressure": lambda v: setDeadband("pressure", v),
+    "maxsilence": setMaxSilence,
+    "repeatwindow": setRepeatWindow,
+    "duplicatewindow": setDuplicateWindow,
+}
+QualifiedOptions = {
+    "mininterval": setMinWriteInterval,
+    "aggregate": setAggregation,
+}
+
+def checkConfiguration():
+    """
+    Warnings about configured options which have no effect.
+    """
+    warnings = []
+    intervals = [cls.MinWriteInterval for cls in ProxyObjects] + list(_minWriteIntervals.values())
+    if _aggregation and not _writeWindow and not any(intervals):
+        warnings.append("aggregate has no effect without mininterval or a write window, every reading is written")
+    return warnings
+
+def configure(options):
+    """
+    Apply options given as "name=value;name=value", see Options.
+    """
+    for item in options.split(';'):
+        if not item.strip():
+            continue
+        (name, sep, value) = item.partition('=')
+        (name, dot, qualifier) = name.strip().partition('.')
+        name = name.lower()
+        if not sep:
+            raise ValueError("Unknown option: "+item.strip())
+        if name in QualifiedOptions:
+            QualifiedOptions[name](qualifier if dot else None, value.strip())
+        elif name in Options and not dot:
+            Options[name](value.strip())
+        else:
+            raise ValueError("Unknown option: "+item.strip())
+
+
+def allocateUnit(devices):
+    return _getDeviceIndex(devices).allocateUnit()
     
 def _createDeviceByName(devices, createDevice, deviceID, typeName):
-    umax = _getNextUnitId(devices)
+    umax = allocateUnit(devices)
     createDevice(Name=deviceID, Unit=umax, TypeName=typeName, DeviceID=deviceID, Used=1).Create()
+    _getDeviceIndex(devices).add(umax)
 
 def _createDeviceByType(devices, createDevice, deviceID, type, subtype, switchtype):
-    umax = _getNextUnitId(devices)
+    umax = allocateUnit(devices)
     createDevice(Name=deviceID, Unit=umax, Type=type, Subtype=subtype, Switchtype=switchtype, DeviceID=deviceID, Used=1).Create()
+    _getDeviceIndex(devices).add(umax)
 
 def _getSensorModel(topic, data):
     t = topic.getInTopic()
-    if t == 'Basic/Report Attributes/ModelIdentifier':
-        jdata = json.loads(data)
+    if t == ModelTopics[0]:
+        jdata = _loads(data)
+        return jdata['value']
+    if t == ModelTopics[1]:
+        # No 'success' when the hub could not read the attribute
+        jdata = _loads(data).get('success')
+        if jdata is None:
+            return None
         return jdata['value']
-    if t == 'Basic/Read Attributes Response/ModelIdentifier':
-        jdata = json.loads(data)
-        return jdata['success']['value']
     return None
 
 
+# AqaraHub "type" tags of integer values
+_IntegerTypes = frozenset(["int8", "int16", "int24", "int32", "int40", "int48", "int56", "int64",
+                           "uint8", "uint16", "uint24", "uint32", "uint40", "uint48", "uint56", "uint64",
+                           "enum8", "enum16", "data8", "data16"])
+
+def _compileConverter(vtype):
+    """
+    Converter of a field specification: a scale, "bool" or "map8". The
+    returned conv(tag, vraw) gets the AqaraHub type tag of the value along
+    with the value.
+    """
+    if vtype == "bool":
+        def conv(tag, vraw):
+            if tag == "bool":
+                return vraw
+            return bool(vraw)
+        return conv
+    if vtype == "map8":
+        def conv(tag, vraw):
+            if tag in _IntegerTypes:
+                return bool(vraw & 1)
+            return vraw[0]
+        return conv
+    scale = float(vtype)
+    def conv(tag, vraw):
+        if tag in _IntegerTypes:
+            return vraw * scale
+        return float(vraw) * scale
+    return conv
+
+
+def _compileField(c, route=None):
+    """
+    Returns apply(obj, tag, vraw), False when the value was ignored. With
+    route given the setter is reachable via several topics and a value just
+    applied via another route is ignored, see _duplicateWindow.
+    """
+    conv = _compileConverter(c[0])
+    setter = c[1]
+
+    if route is None:
+        def apply(obj, tag, vraw):
+            setter(obj, conv(tag, vraw))
+            return True
+        return apply
+
+    def apply(obj, tag, vraw):
+        value = conv(tag, vraw)
+        now = _clock()
+        applied = obj.applied
+        if applied is None:
+            applied = obj.applied = {}
+        last = applied.get(setter)
+        if last is not None and last[0] == value and last[2] != route and now - last[1] < _duplicateWindow:
+            _duplicates.inc()
+            return False
+        applied[setter] = (value, now, route)
+        setter(obj, value)
+        return True
+    return apply
+
+
+def _linkQualityHandler(obj, data):
+    obj.signal = int(int(data)/10)
+    obj.commit()
+
+
+def _compileDataTopicHandler(c, route=None):
+    apply = _compileField(c, route)
+
+    def handler(obj, data):
+        jdata = _loads(data)
+        if apply(obj, jdata.get('type'), jdata['value']):
+            obj.commit()
+    return handler
+
+
+def _compileXiaomiHandler(fields, shared=()):
+    """
+    Apply all known fields of a 0xFF01 block, then commit once. Fields
+    with setters in shared are checked for duplicates.
+    """
+    applies = {}
+    for i in fields:
+        applies[i] = _compileField(fields[i], XiaomiTopic if fields[i][1] in shared else None)
+
+    def handler(obj, data):
+        values = _loads(data)['value']
+        u = False
+        for i in values:
+            apply = applies.get(i)
+            if apply is not None:
+                v = values[i]
+                if apply(obj, v.get('type'), v['value']):
+                    u = True
+        if u:
+            obj.commit()
+    return handler
+
+
+def _compileClassRoutes(cls):
+    """
+    Route key -> handler table of an adapter class, compiled from its
+    DataTopic and XiaomiFields, see Topic.getRouteKey().
+    """
+    setters = [c[1] for c in cls.DataTopic.values()] + [c[1] for c in cls.XiaomiFields.values()]
+    shared = frozenset([f for f in setters if setters.count(f) > 1])
+    routes = {LinkQualityTopic: _linkQualityHandler}
+    for t in cls.DataTopic:
+        c = cls.DataTopic[t]
+        routes[t] = _compileDataTopicHandler(c, t if c[1] in shared else None)
+    if cls.XiaomiFields:
+        routes[XiaomiTopic] = _compileXiaomiHandler(cls.XiaomiFields, shared)
+    return routes
+
+
 class XiaomiSensorWithBatteryAndLinkquality:
+    """
+    Adapters are slotted and keep only their Domoticz device, devices is
+    accepted for the getAdapter() signature but not stored.
+    """
+    __slots__ = ("deviceObj", "batt", "signal", "written", "writtenTime", "createdTime", "lastSeen", "payloads", "applied", "aggregates")
+
     def __init__(self, devices, deviceObj):
-        self.devices = devices
         self.deviceObj = deviceObj
         #SignalLevel 0-100
         #BatteryLevel 0-255
         self.batt = self.deviceObj.BatteryLevel
         self.signal = self.deviceObj.SignalLevel
+        # (batt, signal, Measurements values) last written, see isUnchanged()
+        self.written = None
+        self.writtenTime = 0
+        self.createdTime = _clock()
+        self.lastSeen = None
+        # Route key -> (last payload, time), see _repeatWindow
+        self.payloads = None
+        # Setter -> (value, time, route key), see _compileField()
+        self.applied = None
+        # Measurement -> Aggregator, see aggregate()
+        self.aggregates = None
 
     def processData(self, topic, data):
-        inTopic = topic.getInTopic()
-        if topic.getTopic() == 'linkquality':
-            self.signal = int(int(data)/10)
-            self.update()
-        elif inTopic in self.DataTopic:
-            jdata = json.loads(data)
-            c = self.DataTopic[inTopic]
-            self.processValue(c, jdata['value'])
-            self.update()
-        elif inTopic == 'Basic/Report Attributes/0xFF01':
-            jdata = json.loads(data)
-            for i in jdata['value']:
-                u = False
-                if i in self.XiaomiFields:
-                    c = self.XiaomiFields[i]
-                    vraw = jdata['value'][i]['value']
-                    self.processValue(c, vraw)
-                    u = True
-                if u:
-                    self.update()
-
-    def processValue(self, c, vraw):
-        vtype = c[0]
-        if vtype == "bool":
-            v = vraw
-        elif vtype == "map8":
-            v = vraw[0]
+        now = self.lastSeen = _clock()
+        key = topic.getRouteKey()
+        handler = self.Routes.get(key)
+        if handler:
+            if _repeatWindow:
+                payloads = self.payloads
+                if payloads is None:
+                    payloads = self.payloads = {}
+                last = payloads.get(key)
+                if last is not None and last[0] == data and now - last[1] < _repeatWindow:
+                    _repeats.inc()
+                    return
+                payloads[key] = (data, now)
+            handler(self, data)
+
+    def getSnapshot(self):
+        return dict([(f, getattr(self, f)) for f in self.SnapshotFields])
+
+    def restoreSnapshot(self, state):
+        for f in self.SnapshotFields:
+            if f in state:
+                setattr(self, f, state[f])
+
+    def write(self, nValue, sValue, **kwargs):
+        _writes.inc()
+        self.deviceObj.Update(nValue, sValue, **kwargs)
+        self.writtenTime = _clock()
+
+    def aggregate(self, measurement, value):
+        """
+        Add a reading of measurement, returns the value to store: the
+        reading itself, or with aggregation configured the aggregate of the
+        readings since the last write.
+        """
+        mode = _aggregation.get(measurement)
+        if mode is None:
+            return value
+        aggregates = self.aggregates
+        if aggregates is None:
+            aggregates = self.aggregates = {}
+        a = aggregates.get(measurement)
+        if a is None or a.mode != mode:
+            a = aggregates[measurement] = Aggregator(mode)
+        return a.add(value)
+
+    def resetAggregates(self):
+        """
+        Start new aggregation windows, called whenever update() evaluated
+        the current ones, written or not.
+        """
+        if self.aggregates:
+            for a in self.aggregates.values():
+                a.reset()
+
+    def setWritten(self, values):
+        self.written = (self.batt, self.signal, values)
+
+    def isUnchanged(self, values):
+        """
+        True when battery and signal are as last written and values, in the
+        order of Measurements, are within their deadbands of the values last
+        written, unless nothing was written for the max silence period.
+        """
+        w = self.written
+        if w is None or self.batt != w[0] or self.signal != w[1]:
+            return False
+        if _maxSilence and _clock() - max(self.writtenTime, self.createdTime) >= _maxSilence:
+            return False
+        for i in range(len(values)):
+            d = abs(values[i] - w[2][i])
+            if d and d >= _deadbands.get(self.Measurements[i], 0):
+                return False
+        return True
+
+    def commit(self):
+        deviceID = self.deviceObj.DeviceID
+        interval = _minWriteIntervals.get(deviceID, self.MinWriteInterval)
+        if interval and not self.isStateChange():
+            due = self.writtenTime + interval
+            if _clock() < due:
+                # Written with the then latest values once the interval passed
+                key = ('write', deviceID)
+                if key not in _timers:
+                    _timers.schedule(key, due, self.update)
+                return
+        if _writeWindow and not self.ImmediateWrite:
+            _dirty[self] = None
+        elif _deferWrites:
+            _pending[self] = None
         else:
-            v = float(vraw) * vtype
-        c[1](self, v)
+            self.update()
 
     def setXiaomiBattery(self, value):
         base = 2.765
@@ -148,6 +933,30 @@ class XiaomiSensorWithBatteryAndLinkquality:
     def update(self):
         pass
 
+    # Write on every commit(), even when write coalescing is enabled
+    ImmediateWrite = False
+
+    # Names of the values passed to isUnchanged(), keys of the deadbands
+    Measurements = ()
+
+    # Minimum seconds between writes, see setMinWriteInterval()
+    MinWriteInterval = 0
+
+    # Attributes saved by getSnapshot(), only what the Domoticz device does
+    # not keep: values are read back from the device in __init__()
+    SnapshotFields = ("writtenTime", "lastSeen")
+
+    # True when pending changes must not wait for MinWriteInterval
+    def isStateChange(self):
+        return False
+
+    # ModelIdentifier values handled by the class, see registerDevice()
+    Models = []
+
+    @staticmethod
+    def registerDevice(devices, createDevice, deviceID):
+        pass
+
     DataTopic = {
         #"Temperature Measurement/Report Attributes/MeasuredValue": [0.01, setTemperature],
     }
@@ -156,27 +965,39 @@ class XiaomiSensorWithBatteryAndLinkquality:
         #"1": [0.001, XiaomiSensorWithBatteryAndLinkquality.setXiaomiBattery],
     }
 
+    # DataTopic and XiaomiFields compiled when a derived object is defined
+    Routes = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.Routes = _compileClassRoutes(cls)
+
 
 class TempHumBaro(XiaomiSensorWithBatteryAndLinkquality):
+    __slots__ = ("temp", "hum", "baro")
+
     def __init__(self, devices, deviceObj):
         super().__init__(devices, deviceObj)
         #sValue
-        (self.temp, self.hum, self.hum_stat, self.baro, self.forecast) = self.deviceObj.sValue.split(';')
         # Temperature;Humidity;Humidity Status;Barometer;Forecast
-        self.temp = float(self.temp)
-        self.hum = float(self.hum)
-        self.hum_stat = 0
-        self.baro = float(self.baro)
-        self.forecast = 0
+        (temp, hum, hum_stat, baro, forecast) = self.deviceObj.sValue.split(';')
+        self.temp = float(temp)
+        self.hum = float(hum)
+        self.baro = float(baro)
+        self.setWritten((self.temp, self.hum, self.baro))
+
+    hum_stat = 0
+    forecast = 0
 
     TypeName = "Temp+Hum+Baro"
     Type = 84
+    Measurements = ("temperature", "humidity", "pressure")
     
+    Models = ["lumi.weather"]
+
     @staticmethod
-    def registerDevice(devices, createDevice, deviceID, topic, data):
-        m = _getSensorModel(topic, data)
-        if m == "lumi.weather":
-            _createDeviceByName(devices, createDevice, deviceID, TempHumBaro.TypeName)
+    def registerDevice(devices, createDevice, deviceID):
+        _createDeviceByName(devices, createDevice, deviceID, TempHumBaro.TypeName)
 
     @staticmethod
     def getAdapter(devices, deviceObj):
@@ -184,17 +1005,22 @@ class TempHumBaro(XiaomiSensorWithBatteryAndLinkquality):
             return TempHumBaro(devices, deviceObj)
 
     def setTemperature(self, value):
-        self.temp = value
+        self.temp = self.aggregate("temperature", value)
         
     def setHumidity(self, value):
-        self.hum = value
+        self.hum = self.aggregate("humidity", value)
         
     def setPressure(self, value):
-        self.baro = value
+        self.baro = self.aggregate("pressure", value)
 
     def update(self):
+        values = (self.temp, self.hum, self.baro)
+        self.resetAggregates()
+        if self.isUnchanged(values):
+            return
         sValue = ';'.join((format(self.temp, '.2f'), format(self.hum, '.2f'), str(self.hum_stat), format(self.baro, '.2f'), str(self.forecast)))
-        self.deviceObj.Update(0, sValue, BatteryLevel=self.batt, SignalLevel=self.signal)
+        self.write(0, sValue, BatteryLevel=self.batt, SignalLevel=self.signal)
+        self.setWritten(values)
     
     DataTopic = {
         "Temperature Measurement/Report Attributes/MeasuredValue": [0.01, setTemperature],
@@ -210,12 +1036,86 @@ class TempHumBaro(XiaomiSensorWithBatteryAndLinkquality):
     }
 
 
-_timers = {}
-_timersLock = threading.Lock()
+class Aggregator:
+    """
+    Running aggregate of the readings of one measurement. Holds the same
+    few numbers however many readings arrive, reset() starts a new window.
+    """
+    __slots__ = ("mode", "count", "sum", "min", "max")
+
+    Modes = ("mean", "last", "min", "max")
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        mode = self.mode
+        if mode == "mean":
+            return self.sum / self.count
+        if mode == "min":
+            return self.min
+        if mode == "max":
+            return self.max
+        return value
+
+
+class TimerQueue:
+    """
+    One-shot timers keyed by DeviceID (or a tuple including it), kept in a
+    heap of deadlines.
+
+    Nothing runs on its own: run() fires the due timers and is called from
+    onHeartbeat, so callbacks execute on the plugin thread. Rescheduling a
+    key only pushes a new deadline, stale heap entries are skipped when they
+    come due.
+    """
+    def __init__(self):
+        self.heap = []
+        self.timers = {}
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, deadline, callback):
+        self.timers[key] = (deadline, callback)
+        heapq.heappush(self.heap, (deadline, next(self.sequence), key))
+
+    def cancel(self, key):
+        self.timers.pop(key, None)
+
+    def run(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            (deadline, seq, key) = heapq.heappop(self.heap)
+            t = self.timers.get(key)
+            if t is not None and t[0] == deadline:
+                del self.timers[key]
+                t[1]()
+
+
+_timers = TimerQueue()
 
 _allowTimers = True
 
 class MotionSensor(XiaomiSensorWithBatteryAndLinkquality):
+    __slots__ = ("value", "illuminance", "motionTimeout")
+
     def __init__(self, devices, deviceObj):
         super().__init__(devices, deviceObj)
         #nValue
@@ -226,12 +1126,13 @@ class MotionSensor(XiaomiSensorWithBatteryAndLinkquality):
     Type = 244
     SubType = 73
     SwitchType = 8
+    ImmediateWrite = True
     
+    Models = ["lumi.sensor_motion.aq2"]
+
     @staticmethod
-    def registerDevice(devices, createDevice, deviceID, topic, data):
-        m = _getSensorModel(topic, data)
-        if m == "lumi.sensor_motion.aq2":
-            _createDeviceByType(devices, createDevice, deviceID, MotionSensor.Type, MotionSensor.SubType, MotionSensor.SwitchType)
+    def registerDevice(devices, createDevice, deviceID):
+        _createDeviceByType(devices, createDevice, deviceID, MotionSensor.Type, MotionSensor.SubType, MotionSensor.SwitchType)
 
     @staticmethod
     def getAdapter(devices, deviceObj):
@@ -239,41 +1140,21 @@ class MotionSensor(XiaomiSensorWithBatteryAndLinkquality):
             return MotionSensor(devices, deviceObj)
 
     def update(self):
-        global _allowTimers
-        global _timersLock
-
-        _timersLock.acquire()
-        try:
-            obj = self.deviceObj
-            if not (self.value == obj.nValue and self.illuminance == obj.sValue and self.batt == obj.BatteryLevel and self.signal == obj.SignalLevel):
-                self.deviceObj.Update(self.value, self.illuminance, BatteryLevel=self.batt, SignalLevel=self.signal)
-            if self.value == 1 and _allowTimers:
-                self.updateTimer()
-        finally:
-            _timersLock.release()
-            
-    # Called from CriticalSection
+        obj = self.deviceObj
+        if not (self.value == obj.nValue and self.illuminance == obj.sValue and self.batt == obj.BatteryLevel and self.signal == obj.SignalLevel):
+            self.write(self.value, self.illuminance, BatteryLevel=self.batt, SignalLevel=self.signal)
+        if self.value == 1 and _allowTimers:
+            self.updateTimer()
+
+    def isStateChange(self):
+        return self.value != self.deviceObj.nValue
+
     def updateTimer(self):
-        global _timers
-
-        devId = self.deviceObj.DeviceID
-        if devId in _timers:
-            t = _timers[devId][1].cancel()
-        tm = threading.Timer(self.motionTimeout, MotionSensor.timerCallback, [self])
-        _timers[devId] = [self, tm]
-        tm.start()
-    
+        _timers.schedule(self.deviceObj.DeviceID, _clock() + self.motionTimeout, self.timerCallback)
+
     def timerCallback(self):
-        global _timers
-        global _timersLock
-        
-        _timersLock.acquire()
-        try:
-            devId = self.deviceObj.DeviceID
-            self.deviceObj.Update(0, self.illuminance)
-            del _timers[devId]
-        finally:
-            _timersLock.release()
+        self.value = 0
+        self.write(0, self.illuminance)
 
     def setIlluminance(self, value):
         #self.illuminance = str(value)
@@ -281,6 +1162,9 @@ class MotionSensor(XiaomiSensorWithBatteryAndLinkquality):
 
     def setOccupancy(self, value):
         self.value = int(bool(value))
+        # Re-armed here as the write itself may be held back by MinWriteInterval
+        if self.value == 1 and _allowTimers:
+            self.updateTimer()
         
     DataTopic = {
         "Illuminance Measurement/Report Attributes/0x0000": [1, setIlluminance],
@@ -295,6 +1179,8 @@ class MotionSensor(XiaomiSensorWithBatteryAndLinkquality):
 
 
 class DoorSensor(XiaomiSensorWithBatteryAndLinkquality):
+    __slots__ = ("value",)
+
     def __init__(self, devices, deviceObj):
         super().__init__(devices, deviceObj)
         #nValue
@@ -303,12 +1189,13 @@ class DoorSensor(XiaomiSensorWithBatteryAndLinkquality):
     Type = 244
     SubType = 73
     SwitchType = 11
+    ImmediateWrite = True
     
+    Models = ["lumi.sensor_magnet.aq2"]
+
     @staticmethod
-    def registerDevice(devices, createDevice, deviceID, topic, data):
-        m = _getSensorModel(topic, data)
-        if m == "lumi.sensor_magnet.aq2":
-            _createDeviceByType(devices, createDevice, deviceID, DoorSensor.Type, DoorSensor.SubType, DoorSensor.SwitchType)
+    def registerDevice(devices, createDevice, deviceID):
+        _createDeviceByType(devices, createDevice, deviceID, DoorSensor.Type, DoorSensor.SubType, DoorSensor.SwitchType)
 
     @staticmethod
     def getAdapter(devices, deviceObj):
@@ -318,7 +1205,10 @@ class DoorSensor(XiaomiSensorWithBatteryAndLinkquality):
     def update(self):
         obj = self.deviceObj
         if not (self.value == obj.nValue and self.batt == obj.BatteryLevel and self.signal == obj.SignalLevel):
-            self.deviceObj.Update(self.value, "", BatteryLevel=self.batt, SignalLevel=self.signal)
+            self.write(self.value, "", BatteryLevel=self.batt, SignalLevel=self.signal)
+
+    def isStateChange(self):
+        return self.value != self.deviceObj.nValue
             
     def setDoorOpen(self, value):
         self.value = int(bool(value))
@@ -333,6 +1223,8 @@ class DoorSensor(XiaomiSensorWithBatteryAndLinkquality):
     }
 
 class VibrationSensor(XiaomiSensorWithBatteryAndLinkquality):
+    __slots__ = ("value",)
+
     def __init__(self, devices, deviceObj):
         super().__init__(devices, deviceObj)
         #nValue%
@@ -341,12 +1233,13 @@ class VibrationSensor(XiaomiSensorWithBatteryAndLinkquality):
     Type = 244
     SubType = 73
     SwitchType = 11
+    ImmediateWrite = True
     
+    Models = ["lumi.vibration.aq1"]
+
     @staticmethod
-    def registerDevice(devices, createDevice, deviceID, topic, data):
-        m = _getSensorModel(topic, data)
-        if m == "lumi.vibration.aq1":
-            _createDeviceByType(devices, createDevice, deviceID, VibrationSensor.Type, VibrationSensor.SubType, VibrationSensor.SwitchType)
+    def registerDevice(devices, createDevice, deviceID):
+        _createDeviceByType(devices, createDevice, deviceID, VibrationSensor.Type, VibrationSensor.SubType, VibrationSensor.SwitchType)
 
     @staticmethod
     def getAdapter(devices, deviceObj):
@@ -356,7 +1249,10 @@ class VibrationSensor(XiaomiSensorWithBatteryAndLinkquality):
     def update(self):
         obj = self.deviceObj
         if not (self.value == obj.nValue and self.batt == obj.BatteryLevel and self.signal == obj.SignalLevel):
-            self.deviceObj.Update(self.value, "", BatteryLevel=self.batt, SignalLevel=self.signal)
+            self.write(self.value, "", BatteryLevel=self.batt, SignalLevel=self.signal)
+
+    def isStateChange(self):
+        return self.value != self.deviceObj.nValue
             
     def setDoorOpen(self, value):
         self.value = int(bool(value))
@@ -372,23 +1268,28 @@ class VibrationSensor(XiaomiSensorWithBatteryAndLinkquality):
 
 
 class TempHum(XiaomiSensorWithBatteryAndLinkquality):
+    __slots__ = ("temp", "hum")
+
     def __init__(self, devices, deviceObj):
         super().__init__(devices, deviceObj)
         #sValue
-        (self.temp, self.hum, self.hum_stat) = self.deviceObj.sValue.split(';')
         # Temperature;Humidity;Humidity Status
-        self.temp = float(self.temp)
-        self.hum = float(self.hum)
-        self.hum_stat = 0
+        (temp, hum, hum_stat) = self.deviceObj.sValue.split(';')
+        self.temp = float(temp)
+        self.hum = float(hum)
+        self.setWritten((self.temp, self.hum))
+
+    hum_stat = 0
 
     TypeName = "Temp+Hum"
     Type = 82
+    Measurements = ("temperature", "humidity")
     
+    Models = ["TH01"]
+
     @staticmethod
-    def registerDevice(devices, createDevice, deviceID, topic, data):
-        m = _getSensorModel(topic, data)
-        if m == "TH01":
-            _createDeviceByName(devices, createDevice, deviceID, TempHum.TypeName)
+    def registerDevice(devices, createDevice, deviceID):
+        _createDeviceByName(devices, createDevice, deviceID, TempHum.TypeName)
 
     @staticmethod
     def getAdapter(devices, deviceObj):
@@ -396,17 +1297,22 @@ class TempHum(XiaomiSensorWithBatteryAndLinkquality):
             return TempHum(devices, deviceObj)
 
     def setTemperature(self, value):
-        self.temp = value
+        self.temp = self.aggregate("temperature", value)
         
     def setHumidity(self, value):
-        self.hum = value
+        self.hum = self.aggregate("humidity", value)
 
     def setBattery(self, value):
         self.batt = int(value)
         
     def update(self):
+        values = (self.temp, self.hum)
+        self.resetAggregates()
+        if self.isUnchanged(values):
+            return
         sValue = ';'.join((format(self.temp, '.2f'), format(self.hum, '.2f'), str(self.hum_stat)))
-        self.deviceObj.Update(0, sValue, BatteryLevel=self.batt, SignalLevel=self.signal)
+        self.write(0, sValue, BatteryLevel=self.batt, SignalLevel=self.signal)
+        self.setWritten(values)
     
     DataTopic = {
         "Temperature Measurement/Report Attributes/MeasuredValue": [0.01, setTemperature],
@@ -419,3 +1325,33 @@ class TempHum(XiaomiSensorWithBatteryAndLinkquality):
 
 
 ProxyObjects = [TempHumBaro, MotionSensor, DoorSensor, VibrationSensor, TempHum]
+
+
+def _compileModels(proxyObjects):
+    models = {}
+    for cls in proxyObjects:
+        for m in cls.Models:
+            models.setdefault(m, cls)
+    return models
+
+
+_models = _compileModels(ProxyObjects)
+# onData latency of each adapter class
+_latencies = dict([(cls, metrics.registry.histogram("latency."+cls.__name__)) for cls in ProxyObjects])
+# Topics anybody consumes, everything else is dropped in onData
+_consumedTopics = frozenset([t for cls in ProxyObjects for t in cls.Routes] + list(ModelTopics))
+
+
+def getSubscribeTopics(rootTopicStr):
+    """
+    MQTT topic filters covering exactly the topics the adapters consume, on
+    all hubs in comma separated rootTopicStr.
+    """
+    topics = []
+    for rootTopic in getRootTopics(rootTopicStr):
+        for t in sorted(_consumedTopics):
+            if t == LinkQualityTopic:
+                topics.append(rootTopic+'/+/'+t)
+            else:
+                topics.append(rootTopic+'/+/+/in/'+t)
+    return topics
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark of adapter.onData against synthetic sensor fleets.
+
+For every fleet size a Devices stand-in is populated with a mix of all the
+adapter types and a random but reproducible stream of AqaraHub publishes is
+pushed through onData. Reported per fleet: messages/second, per-message
+latency percentiles, peak memory allocated while processing, memory held
+per device by its adapter and the number of Device.Update calls.
+
+Fleets are populated directly rather than through registration, so sizes
+above the 255 Units Domoticz allows per hardware are possible.
+"""
+import argparse
+import random
+import time
+import tracemalloc
+import adapter
+import mockdomoticz
+
+RootTopic = "AqaraHub"
+
+XiaomiWeather = '{{"type":"xiaomi_ff01","value":{{"1":{{"type":"uint16","value":{0}}},"10":{{"type":"uint16","value":0}},"100":{{"type":"int16","value":{1}}},"101":{{"type":"uint16","value":{2}}},"102":{{"type":"int32","value":{3}}},"4":{{"type":"uint16","value":17320}},"5":{{"type":"uint16","value":6}},"6":{{"type":"uint40","value":1}}}}}}'
+XiaomiSwitch = '{{"type":"xiaomi_ff01","value":{{"1":{{"type":"uint16","value":{0}}},"10":{{"type":"uint16","value":0}},"100":{{"type":"bool","value":{1}}},"3":{{"type":"int8","value":22}},"4":{{"type":"uint16","value":424}},"5":{{"type":"uint16","value":102}},"6":{{"type":"uint40","value":1}}}}}}'
+
+
+def _bool(rnd):
+    return rnd.choice(("true", "false"))
+
+def _weather(rnd):
+    return [
+        (3, "linkquality", lambda: str(rnd.randint(0, 255))),
+        (3, "1/in/Temperature Measurement/Report Attributes/MeasuredValue", lambda: '{"type":"int16","value":%d}' % rnd.randint(1500, 3000)),
+        (3, "1/in/Relative Humidity Measurement/Report Attributes/MeasuredValue", lambda: '{"type":"uint16","value":%d}' % rnd.randint(3000, 7000)),
+        (3, "1/in/Pressure Measurement/Report Attributes/ScaledValue", lambda: '{"type":"int16","value":%d}' % rnd.randint(9900, 10300)),
+        (1, "1/in/Basic/Report Attributes/0xFF01", lambda: XiaomiWeather.format(rnd.randint(2800, 3100), rnd.randint(1500, 3000), rnd.randint(3000, 7000), rnd.randint(99000, 103000))),
+    ]
+
+def _motion(rnd):
+    return [
+        (3, "linkquality", lambda: str(rnd.randint(0, 255))),
+        (2, "1/in/Illuminance Measurement/Report Attributes/0x0000", lambda: '{"type":"uint16","value":%d}' % rnd.randint(0, 100)),
+        (4, "1/in/Occupancy Sensing/Report Attributes/Occupancy", lambda: '{"type":"map8","value":[true,false,false,false,false,false,false,false]}'),
+        (1, "1/in/Basic/Report Attributes/0xFF01", lambda: XiaomiSwitch.format(rnd.randint(2800, 3100), _bool(rnd))),
+    ]
+
+def _switch(rnd):
+    return [
+        (3, "linkquality", lambda: str(rnd.randint(0, 255))),
+        (4, "1/in/OnOff/Report Attributes/OnOff", lambda: '{"type":"bool","value":%s}' % _bool(rnd)),
+        (1, "1/in/Basic/Report Attributes/0xFF01", lambda: XiaomiSwitch.format(rnd.randint(2800, 3100), _bool(rnd))),
+    ]
+
+def _th01(rnd):
+    return [
+        (3, "linkquality", lambda: str(rnd.randint(0, 255))),
+        (3, "1/in/Temperature Measurement/Report Attributes/MeasuredValue", lambda: '{"type":"int16","value":%d}' % rnd.randint(1500, 3000)),
+        (3, "1/in/Relative Humidity Measurement/Report Attributes/MeasuredValue", lambda: '{"type":"uint16","value":%d}' % rnd.randint(3000, 7000)),
+        (1, "1/in/Power Configuration/Report Attributes/Battery Percentage Remaining", lambda: '{"type":"uint8","value":%d}' % rnd.randint(0, 200)),
+    ]
+
+# Device kinds: (Domoticz device arguments, message mix)
+Kinds = [
+    ({"TypeName": adapter.TempHumBaro.TypeName}, _weather),
+    ({"Type": adapter.MotionSensor.Type, "Subtype": adapter.MotionSensor.SubType, "Switchtype": adapter.MotionSensor.SwitchType}, _motion),
+    ({"Type": adapter.DoorSensor.Type, "Subtype": adapter.DoorSensor.SubType, "Switchtype": adapter.DoorSensor.SwitchType}, _switch),
+    ({"TypeName": adapter.TempHum.TypeName}, _th01),
+]
+
+
+def buildFleet(size):
+    devices = mockdomoticz.Devices()
+    for Unit in range(1, size+1):
+        kwargs = dict(Kinds[Unit % len(Kinds)][0])
+        kwargs["DeviceID"] = "00158D%010X" % Unit
+        devices.createDevice(Name=kwargs["DeviceID"], Unit=Unit, Used=1, **kwargs).Create()
+    return devices
+
+
+def buildMessages(devices, count, seed):
+    """
+    Random publishes from devices of the fleet; one in fifty comes from a
+    device unknown to Domoticz.
+    """
+    rnd = random.Random(seed)
+    mixes = []
+    for Unit in sorted(devices):
+        mix = Kinds[Unit % len(Kinds)][1](rnd)
+        weights = [m[0] for m in mix]
+        mixes.append((devices[Unit].DeviceID, mix, weights))
+    messages = []
+    for i in range(count):
+        if rnd.randint(0, 49) == 0:
+            messages.append((RootTopic+"/00124B%010X/linkquality" % rnd.randint(0, 100), str(rnd.randint(0, 255)).encode()))
+            continue
+        (deviceID, mix, weights) = rnd.choice(mixes)
+        m = rnd.choices(mix, weights)[0]
+        messages.append((RootTopic+"/"+deviceID+"/"+m[1], m[2]().encode()))
+    return messages
+
+
+def _percentile(sortedValues, p):
+    return sortedValues[min(int(len(sortedValues) * p / 100), len(sortedValues) - 1)]
+
+
+def adapterMemory(devices):
+    """
+    Bytes allocated per device to create and cache the adapters of all
+    devices.
+    """
+    index = adapter._getDeviceIndex(devices)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for Unit in devices:
+        index.getAdapter(Unit)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return allocated / len(devices)
+
+
+def runFleet(size, count, seed):
+    adapter._timers = adapter.TimerQueue()
+    devices = buildFleet(size)
+    messages = buildMessages(devices, count, seed)
+    adapter.onStart(devices)
+    bytesPerDevice = adapterMemory(devices)
+    onData = adapter.onData
+    createDevice = devices.createDevice
+
+    # Warm up caches, then measure
+    for (topic, payload) in messages[:size*4]:
+        onData(devices, createDevice, RootTopic, topic, payload)
+    updates = devices.getUpdateCount()
+
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for (topic, payload) in messages:
+        t = clock()
+        onData(devices, createDevice, RootTopic, topic, payload)
+        latencies.append(clock() - t)
+    elapsed = clock() - start
+    updates = devices.getUpdateCount() - updates
+
+    tracemalloc.start()
+    for (topic, payload) in messages:
+        onData(devices, createDevice, RootTopic, topic, payload)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "devices": size,
+        "messages": count,
+        "rate": count / elapsed,
+        "p50": _percentile(latencies, 50) * 1e6,
+        "p90": _percentile(latencies, 90) * 1e6,
+        "p99": _percentile(latencies, 99) * 1e6,
+        "max": latencies[-1] * 1e6,
+        "peakKiB": peak / 1024.0,
+        "B/dev": bytesPerDevice,
+        "updates": updates,
+    }
+
+
+Columns = [
+    ("devices", "{0:>8}", "{0:>8d}"),
+    ("messages", "{0:>9}", "{0:>9d}"),
+    ("rate", "{0:>11}", "{0:>11.0f}"),
+    ("p50", "{0:>8}", "{0:>8.1f}"),
+    ("p90", "{0:>8}", "{0:>8.1f}"),
+    ("p99", "{0:>8}", "{0:>8.1f}"),
+    ("max", "{0:>9}", "{0:>9.1f}"),
+    ("peakKiB", "{0:>8}", "{0:>8.1f}"),
+    ("B/dev", "{0:>6}", "{0:>6.0f}"),
+    ("updates", "{0:>8}", "{0:>8d}"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,500,2000", help="comma separated fleet sizes")
+    parser.add_argument("--messages", type=int, default=20000, help="messages per fleet")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("rate in messages/s, latencies in microseconds")
+    print(" ".join([c[1].format(c[0]) for c in Columns]))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        r = runFleet(size, args.messages, args.seed)
+        print(" ".join([c[2].format(r[c[0]]) for c in Columns]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Run the adapter as a standalone asyncio process instead of a Domoticz
+plugin.
+
+Same adapter classes and device semantics as the plugin: AqaraHub publishes
+are fed to adapter.onData with a mockdomoticz.Devices stand-in, timers and
+write windows are serviced by a heartbeat task and unknown devices are
+asked for their model. Every device write is published as JSON to
+<out topic>/<DeviceID>, so parsing and routing run independently of the
+Domoticz event loop. A lost broker connection is re-established with
+backoff, keeping devices and timers.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import ssl
+import time
+import adapter
+import mockdomoticz
+import mqtt
+
+
+_log = logging.getLogger("bridge")
+
+# Seconds before reconnecting to the broker, doubled after every failed
+# attempt up to MaxReconnectDelay
+ReconnectDelay = 1
+MaxReconnectDelay = 60
+
+
+class BridgeDevices(mockdomoticz.Devices):
+    def __init__(self, client, outTopic):
+        super().__init__()
+        self.client = client
+        self.outTopic = outTopic
+
+    def onUpdate(self, device):
+        state = {"Unit": device.Unit, "nvalue": device.nValue, "svalue": device.sValue, "Battery": device.BatteryLevel, "RSSI": device.SignalLevel}
+        self.client.publish(self.outTopic+"/"+device.DeviceID, json.dumps(state))
+
+
+class Bridge:
+    def __init__(self, client, rootTopic, outTopic, heartbeat=10):
+        self.client = client
+        self.rootTopic = rootTopic
+        self.heartbeat = heartbeat
+        self.devices = BridgeDevices(client, outTopic)
+        self.heartbeatTask = None
+
+    def onMessage(self, topic, payload):
+        try:
+            adapter.onData(self.devices, self.devices.createDevice, self.rootTopic, topic, payload)
+        except adapter.NoFreeUnitError as e:
+            _log.error("Cannot create device for %s: %s", topic, e)
+        except Exception:
+            _log.exception("Processing message on %s failed: %r", topic, payload)
+
+    def onHeartbeat(self):
+        adapter.onHeartbeat()
+        for (topic, payload) in adapter.getDiscoveryRequests(self.devices, self.rootTopic):
+            self.client.publish(topic, payload)
+
+    async def run(self):
+        """
+        Process messages of the connected client until the connection
+        closes.
+        """
+        self.start()
+        try:
+            await self.serve()
+        finally:
+            self.stop()
+
+    def start(self):
+        adapter.onStart(self.devices)
+        self.heartbeatTask = asyncio.ensure_future(self._heartbeat())
+
+    def stop(self):
+        self.heartbeatTask.cancel()
+        adapter.onStop()
+
+    async def serve(self):
+        """
+        Subscribe on the current connection of the client and process its
+        messages until it closes, devices and timers are kept across
+        connections.
+        """
+        self.client.subscribe(adapter.getSubscribeTopics(self.rootTopic))
+        await self.client.run(self.onMessage)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            self.onHeartbeat()
+            try:
+                await self.client.drain()
+            except ConnectionError:
+                pass
+
+
+async def _main(args):
+    client = mqtt.Client()
+    clientId = "AqaraHub-bridge_{0}_{1}".format(int(time.time()), random.randint(1000, 9999))
+    context = ssl.create_default_context() if args.tls else None
+    bridge = Bridge(client, args.topic, args.out_topic, args.heartbeat)
+    bridge.start()
+    delay = ReconnectDelay
+    try:
+        while True:
+            try:
+                await client.connect(args.host, args.port, clientId, args.username, args.password, ssl=context)
+            except (OSError, asyncio.IncompleteReadError, mqtt.MQTTError) as e:
+                _log.error("Cannot connect to %s:%d: %s", args.host, args.port, e)
+            else:
+                connected = time.monotonic()
+                try:
+                    await bridge.serve()
+                except (OSError, mqtt.MQTTError) as e:
+                    _log.error("Connection to %s:%d failed: %s", args.host, args.port, e)
+                if time.monotonic() - connected >= MaxReconnectDelay:
+                    delay = ReconnectDelay
+            _log.warning("Disconnected from %s:%d, reconnecting in %gs", args.host, args.port, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MaxReconnectDelay)
+    finally:
+        bridge.stop()
+        await client.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--tls", action="store_true", help="connect with TLS")
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    parser.add_argument("--topic", default="AqaraHub", help="AqaraHub root topics, comma separated")
+    parser.add_argument("--out-topic", default="aqarahub-bridge", help="topic prefix device writes are published to")
+    parser.add_argument("--heartbeat", type=float, default=10, help="seconds between heartbeats")
+    parser.add_argument("--options", default="", help="adapter options, as the plugin Options parameter")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    adapter.configure(args.options)
+    for warning in adapter.checkConfiguration():
+        _log.warning(warning)
+    asyncio.run(_main(args))
+
+
+if __name__ == '__main__':
+    main()
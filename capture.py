@@ -0,0 +1,55 @@
+# Python Plugin AqaraHub MQTT
+#
+# Author: michlv
+#
+"""
+Capture files of MQTT traffic, written by the plugin and read by replay.py.
+
+One JSON value per line: an object describing a Domoticz device as it was
+when the capture started, or a [timestamp, topic, payload] array for each
+received publish. Payload bytes are stored as text, with bytes that are not
+UTF-8 kept as surrogate escapes.
+"""
+import json
+
+DeviceFields = ("Unit", "DeviceID", "Type", "SubType", "SwitchType", "nValue", "sValue", "BatteryLevel", "SignalLevel")
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def writeDevices(self, devices):
+        for Unit in sorted(devices):
+            dev = devices[Unit]
+            record = {}
+            for f in DeviceFields:
+                record[f] = getattr(dev, f)
+            self.file.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def writeMessage(self, timestamp, topic, payload):
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8", "surrogateescape")
+        self.file.write(json.dumps([round(timestamp, 3), topic, payload], separators=(',', ':')) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read(path):
+    """
+    Yield ("device", record) and ("message", (timestamp, topic, payload))
+    tuples in file order, payload as bytes.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            v = json.loads(line)
+            if isinstance(v, dict):
+                yield ("device", v)
+            else:
+                yield ("message", (v[0], v[1], v[2].encode("utf-8", "surrogateescape")))
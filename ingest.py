@@ -0,0 +1,108 @@
+# Python Plugin AqaraHub MQTT
+#
+# Author: michlv
+#
+"""
+Bounded queue between the Domoticz message callback and adapter.onData.
+
+put() only appends the raw (topic, payload) and returns, a worker thread
+drains the queue in batches. There is a single worker and the queue is FIFO,
+so messages of every device are processed in the order they arrived. The
+worker holds lock while it processes a batch; anything else touching the
+adapter (heartbeat, device callbacks) must hold it too.
+"""
+import collections
+import threading
+import metrics
+
+# Overflow policies: refuse the incoming message or evict the oldest queued one
+DropNewest = "drop-newest"
+DropOldest = "drop-oldest"
+
+_dropped = metrics.registry.counter("ingest.dropped")
+_depth = metrics.registry.gauge("ingest.depth")
+
+
+class IngestQueue:
+    def __init__(self, process, maxSize=1000, batchSize=50, policy=DropOldest, onError=None):
+        """
+        process(topic, payload) is called on the worker thread, exceptions
+        it raises are passed to onError(topic, payload, exception).
+        """
+        if policy not in (DropNewest, DropOldest):
+            raise ValueError("Unknown overflow policy: " + str(policy))
+        self.process = process
+        self.maxSize = maxSize
+        self.batchSize = batchSize
+        self.policy = policy
+        self.onError = onError
+        self.messages = collections.deque()
+        self.busy = 0
+        self.running = False
+        self.thread = None
+        self.cond = threading.Condition()
+        self.lock = threading.RLock()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="AqaraHub-MQTT ingest", daemon=True)
+        self.thread.start()
+
+    def put(self, topic, payload):
+        """
+        Queue a message, returns False when it was dropped.
+        """
+        with self.cond:
+            if len(self.messages) >= self.maxSize:
+                _dropped.inc()
+                if self.policy == DropNewest:
+                    return False
+                self.messages.popleft()
+            self.messages.append((topic, payload))
+            _depth.set(len(self.messages))
+            self.cond.notify_all()
+        return True
+
+    def drain(self, timeout=None):
+        """
+        Wait until every queued message has been processed, returns False
+        on timeout.
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.messages and not self.busy, timeout)
+
+    def stop(self, timeout=None):
+        """
+        Process what is queued, then stop the worker.
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def _run(self):
+        messages = self.messages
+        while True:
+            with self.cond:
+                while not messages and self.running:
+                    self.cond.wait()
+                if not messages:
+                    return
+                batch = [messages.popleft() for i in range(min(self.batchSize, len(messages)))]
+                self.busy = len(batch)
+                _depth.set(len(messages))
+            with self.lock:
+                for (topic, payload) in batch:
+                    try:
+                        self.process(topic, payload)
+                    except Exception as e:
+                        if self.onError:
+                            self.onError(topic, payload, e)
+            with self.cond:
+                self.busy = 0
+                self.cond.notify_all()
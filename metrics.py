@@ -0,0 +1,119 @@
+# Python Plugin AqaraHub MQTT
+#
+# Author: michlv
+#
+"""
+Counters and fixed-bucket histograms, cheap enough for the per-message path.
+"""
+import bisect
+
+# Upper bounds in seconds of the latency buckets, the last bucket is unbounded
+LatencyBuckets = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge:
+    """
+    Last set value and the maximum since the last resetMax().
+    """
+    def __init__(self):
+        self.value = 0
+        self.max = 0
+
+    def set(self, value):
+        self.value = value
+        if value > self.max:
+            self.max = value
+
+    def resetMax(self):
+        self.max = self.value
+
+
+class Histogram:
+    """
+    Counts per bucket, with the sum and the maximum of the observed values.
+    """
+    def __init__(self, buckets=LatencyBuckets):
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th percentile, the maximum
+        observed value for the unbounded bucket, None when empty.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        n = 0
+        for i in range(len(self.counts)):
+            n += self.counts[i]
+            if n >= rank and self.counts[i]:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                return self.max
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.sum / self.count
+
+    def merge(self, other):
+        for i in range(len(self.counts)):
+            self.counts[i] += other.counts[i]
+        self.count += other.count
+        self.sum += other.sum
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def counter(self, name):
+        c = self.counters.get(name)
+        if c is None:
+            c = self.counters[name] = Counter()
+        return c
+
+    def gauge(self, name):
+        g = self.gauges.get(name)
+        if g is None:
+            g = self.gauges[name] = Gauge()
+        return g
+
+    def histogram(self, name, buckets=LatencyBuckets):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram(buckets)
+        return h
+
+    def getCounterValues(self):
+        return dict([(name, self.counters[name].value) for name in self.counters])
+
+
+registry = Registry()
@@ -0,0 +1,75 @@
+# Python Plugin AqaraHub MQTT
+#
+# Author: michlv
+#
+"""
+Stand-in for the Domoticz Device objects and Devices dictionary, for running
+the adapter outside Domoticz (benchmarks, replays).
+"""
+
+# TypeName -> (Type, SubType, initial sValue)
+TypeNames = {
+    "Temp+Hum+Baro": (84, 1, "0;0;0;0;0"),
+    "Temp+Hum": (82, 1, "0;0;0"),
+}
+
+
+class Device:
+    def __init__(self, Name=None, Unit=None, TypeName=None, Type=None, Subtype=None, Switchtype=None, DeviceID=None, Used=None, devices=None):
+        self.Name = Name
+        self.Unit = Unit
+        self.ID = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.DeviceID = DeviceID
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ""
+        self.SignalLevel = 100
+        self.BatteryLevel = 255
+        self.LastLevel = 0
+        self.updateCount = 0
+        if TypeName in TypeNames:
+            (self.Type, self.SubType, self.sValue) = TypeNames[TypeName]
+        self.devices = devices
+
+    def Create(self):
+        self.devices[self.Unit] = self
+
+    def Update(self, nValue, sValue, BatteryLevel=None, SignalLevel=None):
+        self.nValue = nValue
+        self.sValue = sValue
+        if BatteryLevel is not None:
+            self.BatteryLevel = BatteryLevel
+        if SignalLevel is not None:
+            self.SignalLevel = SignalLevel
+        self.updateCount += 1
+        if self.devices is not None:
+            self.devices.onUpdate(self)
+
+    def __str__(self):
+        return "{0} {1} {2};{3}".format(self.Unit, self.DeviceID, self.nValue, self.sValue)
+
+
+class Devices(dict):
+    """
+    Devices dictionary; createDevice is passed to adapter.onData in place of
+    Domoticz.Device.
+    """
+    # No Domoticz behind it, so no 255 Units limit
+    MaxUnit = 2**31 - 1
+
+    def createDevice(self, **kwargs):
+        return Device(devices=self, **kwargs)
+
+    # Called after every Device.Update
+    def onUpdate(self, device):
+        pass
+
+    def getUpdateCount(self):
+        return sum([d.updateCount for d in self.values()])
+
+    def getState(self):
+        return dict([(d.DeviceID, (d.nValue, d.sValue, d.BatteryLevel, d.SignalLevel)) for d in self.values()])
@@ -0,0 +1,248 @@
+# Python Plugin AqaraHub MQTT
+#
+# Author: michlv
+#
+"""
+Minimal asyncio MQTT 3.1.1 client, QoS 0 only, and an in-process broker
+stand-in for testing it. Used by bridge.py to run the adapter outside
+Domoticz.
+"""
+import asyncio
+import struct
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+class MQTTError(Exception):
+    pass
+
+
+def _encodeLength(n):
+    b = bytearray()
+    while True:
+        d = n % 128
+        n //= 128
+        if n:
+            b.append(d | 0x80)
+        else:
+            b.append(d)
+            return bytes(b)
+
+def _encodeString(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return struct.pack("!H", len(s)) + s
+
+def _decodeString(data, offset):
+    (n,) = struct.unpack_from("!H", data, offset)
+    return (data[offset+2:offset+2+n].decode(), offset+2+n)
+
+def packet(type, flags, body=b""):
+    return bytes([(type << 4) | flags]) + _encodeLength(len(body)) + body
+
+def publishPacket(topic, payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return packet(PUBLISH, 0, _encodeString(topic) + payload)
+
+async def readPacket(reader):
+    """
+    Read one packet, returns (type, flags, body).
+    """
+    h = await reader.readexactly(1)
+    n = 0
+    shift = 0
+    while True:
+        b = (await reader.readexactly(1))[0]
+        n += (b & 0x7F) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+        if shift > 21:
+            raise MQTTError("Malformed remaining length")
+    body = await reader.readexactly(n) if n else b""
+    return (h[0] >> 4, h[0] & 0x0F, body)
+
+def parsePublish(flags, body):
+    """
+    Returns (topic, payload, packet identifier or None).
+    """
+    (topic, offset) = _decodeString(body, 0)
+    packetId = None
+    if (flags >> 1) & 3:
+        (packetId,) = struct.unpack_from("!H", body, offset)
+        offset += 2
+    return (topic, body[offset:], packetId)
+
+def topicMatches(topicFilter, topic):
+    f = topicFilter.split('/')
+    t = topic.split('/')
+    for i in range(len(f)):
+        if f[i] == '#':
+            return True
+        if i >= len(t) or (f[i] != '+' and f[i] != t[i]):
+            return False
+    return len(f) == len(t)
+
+
+class Client:
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.packetId = 0
+        self.pingPending = False
+
+    async def connect(self, host, port, clientId, username=None, password=None, keepAlive=60, ssl=None):
+        self.keepAlive = keepAlive
+        self.pingPending = False
+        (self.reader, self.writer) = await asyncio.open_connection(host, port, ssl=ssl)
+        flags = 0x02
+        payload = _encodeString(clientId)
+        if username:
+            flags |= 0x80
+            payload += _encodeString(username)
+            if password:
+                flags |= 0x40
+                payload += _encodeString(password)
+        body = _encodeString("MQTT") + bytes([4, flags]) + struct.pack("!H", keepAlive) + payload
+        self.writer.write(packet(CONNECT, 0, body))
+        (type, flags, body) = await readPacket(self.reader)
+        if type != CONNACK or len(body) < 2 or body[1] != 0:
+            raise MQTTError("Connection refused: {0}".format(body[1] if type == CONNACK and len(body) > 1 else type))
+
+    def subscribe(self, topics):
+        """
+        Subscribe to all topic filters with a single SUBSCRIBE, QoS 0.
+        """
+        self.packetId = self.packetId % 0xFFFF + 1
+        body = struct.pack("!H", self.packetId)
+        for t in topics:
+            body += _encodeString(t) + b"\x00"
+        self.writer.write(packet(SUBSCRIBE, 2, body))
+
+    def publish(self, topic, payload):
+        # QoS 0, dropped while the connection is down
+        if self.writer is None or self.writer.is_closing():
+            return
+        self.writer.write(publishPacket(topic, payload))
+
+    async def drain(self):
+        if self.writer is not None:
+            await self.writer.drain()
+
+    async def run(self, onMessage):
+        """
+        Call onMessage(topic, payload) for every publish until the
+        connection closes or is lost, sending keep alive pings. A ping left
+        without PINGRESP until the next one aborts the connection. An
+        exception raised by onMessage ends run(), callers handle per message
+        errors themselves.
+        """
+        pinger = asyncio.ensure_future(self._ping())
+        try:
+            while True:
+                try:
+                    (type, flags, body) = await readPacket(self.reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                if type == PINGRESP:
+                    self.pingPending = False
+                elif type == PUBLISH:
+                    (topic, payload, packetId) = parsePublish(flags, body)
+                    if packetId is not None:
+                        self.writer.write(packet(PUBACK, 0, struct.pack("!H", packetId)))
+                    onMessage(topic, payload)
+        finally:
+            pinger.cancel()
+
+    async def _ping(self):
+        while True:
+            await asyncio.sleep(self.keepAlive / 2)
+            if self.pingPending:
+                # Broker gone without closing the connection
+                self.writer.transport.abort()
+                return
+            self.pingPending = True
+            self.writer.write(packet(PINGREQ, 0))
+
+    async def disconnect(self):
+        if self.writer is None:
+            return
+        self.writer.write(packet(DISCONNECT, 0))
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        self.writer = None
+
+
+class Broker:
+    """
+    Just enough of an MQTT broker to test against: accepts any client,
+    routes QoS 0 publishes to matching subscriptions, no retained messages.
+    """
+    def __init__(self):
+        self.clients = {}
+        self.server = None
+        # False to test clients against a broker that stopped responding
+        self.answerPings = True
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.dropClients()
+
+    def dropClients(self):
+        for writer in list(self.clients):
+            writer.close()
+
+    def publish(self, topic, payload):
+        data = publishPacket(topic, payload)
+        for writer in self.clients:
+            for f in self.clients[writer]:
+                if topicMatches(f, topic):
+                    writer.write(data)
+                    break
+
+    async def _handle(self, reader, writer):
+        self.clients[writer] = []
+        try:
+            while True:
+                (type, flags, body) = await readPacket(reader)
+                if type == CONNECT:
+                    writer.write(packet(CONNACK, 0, b"\x00\x00"))
+                elif type == SUBSCRIBE:
+                    offset = 2
+                    codes = b""
+                    while offset < len(body):
+                        (f, offset) = _decodeString(body, offset)
+                        offset += 1
+                        self.clients[writer].append(f)
+                        codes += b"\x00"
+                    writer.write(packet(SUBACK, 0, body[:2] + codes))
+                elif type == PUBLISH:
+                    (topic, payload, packetId) = parsePublish(flags, body)
+                    self.publish(topic, payload)
+                elif type == PINGREQ and self.answerPings:
+                    writer.write(packet(PINGRESP, 0))
+                elif type == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.clients[writer]
+            writer.close()
@@ -15,7 +15,16 @@
         </param>
         <param field="Username" label="Username" width="200px"/>
         <param field="Password" label="Password" width="200px"/>
-        <param field="Mode1" label="Topic" width="200px" required="true" default="AqaraHub"/>
+        <param field="Mode1" label="Topics (comma separated)" width="200px" required="true" default="AqaraHub"/>
+        <param field="Mode2" label="Write window (s)" width="40px" default="0"/>
+        <param field="Mode3" label="Capture file" width="200px"/>
+        <param field="Mode4" label="Metrics devices" width="75px">
+            <options>
+                <option label="True" value="true"/>
+                <option label="False" value="false" default="true" />
+            </options>
+        </param>
+        <param field="Mode5" label="Options" width="300px"/>
         <param field="Mode6" label="Debug" width="75px">
             <options>
                 <option label="True" value="Debug"/>
@@ -26,53 +35,266 @@
 </plugin>
 """
 import Domoticz
+import collections
+import os
 import random
 import time
+import traceback
 import adapter
+import capture
+import ingest
+import metrics
 
 PluginName = "AqaraHub-MQTT"
 
+# MQTT keep alive
+PingInterval = 60
+# Dump every n-th message per topic in debug mode
+MessageDumpSampling = 100
+# Raw messages kept for dumpRecentMessages()
+RecentMessages = 50
+# Minimum seconds between dumps of the recent messages on processing errors
+ErrorDumpInterval = 600
+# Push button dumping the recent messages, created with the metrics devices
+DumpDevice = ("diagnostics.dump", "Dump recent messages")
+# Messages queued for the ingest worker before overflow, per batch, overflow policy
+IngestQueueSize = 1000
+IngestBatchSize = 50
+IngestOverflow = ingest.DropOldest
+# Seconds between heartbeats; writes the ingest worker hands back are done
+# at the latest on the next heartbeat
+Heartbeat = 1
+# Seconds between model discovery rounds
+DiscoveryInterval = 10
+# Seconds between metrics summaries
+MetricsInterval = 300
+# Metrics devices: (DeviceID, name, unit)
+MetricsDevices = [
+    ("metrics.messages", "Messages", "msg/s"),
+    ("metrics.p99", "p99 latency", "ms"),
+    ("metrics.writes", "Writes", "writes/s"),
+    ("metrics.dropped", "Dropped messages", "msg/s"),
+]
+
+
+class Logger:
+    """
+    Leveled wrapper around Domoticz logging. Messages are format strings
+    with arguments and are only formatted when the level is enabled.
+    """
+    ERROR = 0
+    LOG = 1
+    DEBUG = 2
+
+    def __init__(self, level=LOG):
+        self.level = level
+
+    def isEnabled(self, level):
+        return self.level >= level
+
+    def error(self, fmt, *args):
+        Domoticz.Error(fmt.format(*args) if args else fmt)
+
+    def log(self, fmt, *args):
+        if self.level >= Logger.LOG:
+            Domoticz.Log(fmt.format(*args) if args else fmt)
+
+    def debug(self, fmt, *args):
+        if self.level >= Logger.DEBUG:
+            Domoticz.Debug(fmt.format(*args) if args else fmt)
+
+_log = Logger()
+
+# Adapter state saved in HomeFolder for warm starts
+SnapshotFile = "AqaraHub-MQTT-state.json"
+SnapshotInterval = 300
+
+
 class BasePlugin:
     enabled = False
     mqttConn = None
     counter = 0
+    pingTicks = 6
+    discoveryTicks = 1
     
     def __init__(self):
+        self.recentMessages = collections.deque(maxlen=RecentMessages)
+        self.dumpCounters = {}
+        self.capture = None
+        self.metricsUnits = None
+        self.dumpUnit = None
+        self.dumpTime = 0
+        self.metricsTime = time.time()
+        self.metricsCounters = metrics.registry.getCounterValues()
+        self.snapshotPath = None
+        self.ingest = None
+        # Calls the ingest worker hands back to the plugin thread
+        self.pluginCalls = collections.deque()
+        # DeviceIDs with a registration handed back, their messages follow it
+        self.registering = set()
+        self.snapshotTime = time.time()
         return
 
     def onStart(self):
         if Parameters["Mode6"] == "Debug":
             Domoticz.Debugging(1)
+            _log.level = Logger.DEBUG
         DumpConfigToLog()
+        adapter.onStart(Devices)
+        try:
+            adapter.configure(Parameters["Mode5"])
+        except ValueError as e:
+            _log.error("Invalid options: {0}", e)
+        try:
+            writeWindow = int(Parameters["Mode2"] or 0)
+        except ValueError:
+            _log.error("Invalid write window: {0}", Parameters["Mode2"])
+            writeWindow = 0
+        Domoticz.Heartbeat(Heartbeat)
+        self.pingTicks = max(PingInterval // Heartbeat, 1)
+        self.discoveryTicks = max(DiscoveryInterval // Heartbeat, 1)
+        adapter.setWriteWindow(writeWindow)
+        adapter.setDeferWrites(True)
+        for warning in adapter.checkConfiguration():
+            _log.log("Warning: {0}", warning)
+        self.snapshotPath = os.path.join(Parameters["HomeFolder"], SnapshotFile)
+        try:
+            if adapter.loadSnapshot(Devices, self.snapshotPath):
+                _log.log("Restored state from {0}", self.snapshotPath)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            _log.error("Ignoring unreadable state {0}: {1}", self.snapshotPath, e)
+        if Parameters["Mode3"]:
+            path = os.path.join(Parameters["HomeFolder"], Parameters["Mode3"])
+            _log.log("Capturing MQTT messages to {0}", path)
+            self.capture = capture.CaptureWriter(path)
+            self.capture.writeDevices(Devices)
+        self.createDumpDevice()
+        if Parameters["Mode4"] == "true":
+            self.createMetricsDevices()
+        self.ingest = ingest.IngestQueue(self.processMessage, IngestQueueSize, IngestBatchSize, IngestOverflow, self.onProcessError)
+        self.ingest.start()
         self.doConnect()
 
     def onConnect(self, Connection, Status, Description):
         if (Status == 0):
-            Domoticz.Debug("MQTT connected successfully.")
+            _log.debug("MQTT connected successfully.")
             id = "Domoticz_{0}_{1}_{2}".format(PluginName, int(time.time()), random.randint(1000, 9999))
             sendData = { 'Verb' : 'CONNECT',
                          'ID' : id }
             Connection.Send(sendData)
         else:
-            Domoticz.Log("Failed to connect ("+str(Status)+") to: "+Parameters["Address"]+":"+Parameters["Port"]+" with error: "+Description)
+            _log.log("Failed to connect ({0}) to: {1}:{2} with error: {3}", Status, Parameters["Address"], Parameters["Port"], Description)
 
     def onMessage(self, Connection, Data):
         verb=Data["Verb"]
-        Domoticz.Log("onMessage called with: "+verb)
-        DumpDictionaryToLog(Data)
+        _log.debug("onMessage called with: {0}", verb)
         if (verb == "CONNACK" and Data['Status'] == 0):
             self.doSubscribe(Connection)
         elif (verb == 'PUBLISH'):
-            adapter.onData(Devices, Domoticz.Device, Parameters["Mode1"], Data['Topic'], Data['Payload'].decode())
+            topic = Data['Topic']
+            now = time.time()
+            self.recentMessages.append((now, topic, Data['Payload']))
+            if self.capture:
+                self.capture.writeMessage(now, topic, Data['Payload'])
+            if _log.isEnabled(Logger.DEBUG):
+                self.sampleMessage(topic, Data)
+            if not self.ingest.put(topic, Data['Payload']):
+                _log.debug("Ingest queue full, dropped message on {0}", topic)
+        # Do not wait for the worker to finish its batch, the next onMessage
+        # or onHeartbeat picks up the calls.
+        if self.ingest.lock.acquire(blocking=False):
+            try:
+                self.runPluginCalls()
+            finally:
+                self.ingest.lock.release()
+
+    # The ingest worker only decodes and routes messages into the adapters.
+    # Everything calling into Domoticz (device writes and creation, logging)
+    # is handed back and done on the plugin thread by runPluginCalls(), from
+    # onMessage when the worker is idle and from onHeartbeat.
+    def processMessage(self, topic, payload):
+        if self.registering:
+            deviceID = adapter.Topic(Parameters["Mode1"], topic).getDeviceID()
+            if deviceID in self.registering:
+                self.pluginCalls.append(lambda: self.registerDevice(topic, payload))
+                return
+        if not adapter.onData(Devices, None, Parameters["Mode1"], topic, payload):
+            self.registering.add(adapter.Topic(Parameters["Mode1"], topic).getDeviceID())
+            self.pluginCalls.append(lambda: self.registerDevice(topic, payload))
+
+    def onProcessError(self, topic, payload, e):
+        error = traceback.format_exc()
+        self.pluginCalls.append(lambda: self.logProcessError(topic, error))
+
+    # With the ingest lock held
+    def runPluginCalls(self):
+        calls = self.pluginCalls
+        while calls:
+            calls.popleft()()
+        self.registering.clear()
+        adapter.flushPending()
+
+    def registerDevice(self, topic, payload):
+        try:
+            adapter.onData(Devices, Domoticz.Device, Parameters["Mode1"], topic, payload)
+        except adapter.NoFreeUnitError as e:
+            _log.error("Cannot create device for {0}: {1}", topic, e)
+        except Exception:
+            self.logProcessError(topic, traceback.format_exc())
+
+    def logProcessError(self, topic, error):
+        _log.error("Processing message on {0} failed: {1}", topic, error.strip().splitlines()[-1])
+        _log.debug("{0}", error)
+        now = time.time()
+        if now - self.dumpTime >= ErrorDumpInterval:
+            self.dumpTime = now
+            self.dumpRecentMessages()
+
+    def sampleMessage(self, topic, Data):
+        n = self.dumpCounters.get(topic, 0)
+        self.dumpCounters[topic] = n + 1
+        if n % MessageDumpSampling == 0:
+            _log.debug("Message {0} on {1}:", n + 1, topic)
+            for x in Data:
+                _log.debug(">'{0}': {1}", x, Data[x])
+
+    def dumpRecentMessages(self):
+        _log.log("Last {0} messages:", len(self.recentMessages))
+        for (t, topic, payload) in self.recentMessages:
+            _log.log("{0:.3f} {1} {2}", t, topic, payload)
+
+    def onCommand(self, Unit, Command, Level, Hue):
+        if Unit == self.dumpUnit:
+            self.dumpRecentMessages()
+
+    def onDeviceAdded(self, Unit):
+        with self.ingest.lock:
+            adapter.onDeviceAdded(Devices, Unit)
+
+    def onDeviceModified(self, Unit):
+        with self.ingest.lock:
+            adapter.onDeviceModified(Devices, Unit)
+
+    def onDeviceRemoved(self, Unit):
+        with self.ingest.lock:
+            adapter.onDeviceRemoved(Devices, Unit)
 
     def onDisconnect(self, Connection):
-        Domoticz.Log("onDisconnect called")
+        _log.log("onDisconnect called")
 
     def onHeartbeat(self):
-        Domoticz.Log("onHeartbeat called: "+str(self.counter))
+        _log.debug("onHeartbeat called: {0}", self.counter)
+        with self.ingest.lock:
+            self.heartbeat()
+
+    def heartbeat(self):
         if (self.mqttConn.Connected()):
-            if ((self.counter % 6) == 0):
+            if ((self.counter % self.pingTicks) == 0):
                 self.mqttConn.Send({ 'Verb' : 'PING' })
+            if ((self.counter % self.discoveryTicks) == 0):
+                for (topic, payload) in adapter.getDiscoveryRequests(Devices, Parameters["Mode1"]):
+                    _log.debug("Requesting model of {0}", topic)
+                    self.mqttConn.Send({'Verb' : 'PUBLISH', 'Topic': topic, 'Payload': payload, 'QoS': 0})
             #elif (self.counter % 45 == 0):
             #    self.mqttConn.Send({'Verb' : 'UNSUBSCRIBE', 'Topics': [Parameters["Mode1"]]})
             #elif (self.counter % 50 == 0):
@@ -80,9 +302,93 @@ class BasePlugin:
             self.counter = self.counter + 1
         else:
             self.doConnect()
+        self.runPluginCalls()
+        adapter.onHeartbeat()
+        if self.capture:
+            self.capture.flush()
+        now = time.time()
+        if now - self.metricsTime >= MetricsInterval:
+            self.reportMetrics(now)
+        if now - self.snapshotTime >= SnapshotInterval:
+            self.saveSnapshot(now)
+
+    def onStop(self):
+        _log.log("onStop called")
+        if self.ingest:
+            self.ingest.stop()
+            self.runPluginCalls()
+        adapter.onStop()
+        self.saveSnapshot(time.time())
+        if self.capture:
+            self.capture.close()
+            self.capture = None
+
+    def saveSnapshot(self, now):
+        self.snapshotTime = now
+        if self.snapshotPath is None:
+            return
+        try:
+            adapter.saveSnapshot(Devices, self.snapshotPath)
+        except OSError as e:
+            _log.error("Cannot save state to {0}: {1}", self.snapshotPath, e)
+
+    def createMetricsDevices(self):
+        units = {}
+        for Unit in Devices:
+            units[Devices[Unit].DeviceID] = Unit
+        self.metricsUnits = {}
+        for (deviceID, name, unit) in MetricsDevices:
+            if deviceID not in units:
+                units[deviceID] = adapter.allocateUnit(Devices)
+                Domoticz.Device(Name=name, Unit=units[deviceID], TypeName="Custom", Options={"Custom": "1;"+unit}, DeviceID=deviceID, Used=1).Create()
+            self.metricsUnits[deviceID] = units[deviceID]
+
+    def createDumpDevice(self):
+        (deviceID, name) = DumpDevice
+        for Unit in Devices:
+            if Devices[Unit].DeviceID == deviceID:
+                self.dumpUnit = Unit
+                return
+        self.dumpUnit = adapter.allocateUnit(Devices)
+        Domoticz.Device(Name=name, Unit=self.dumpUnit, Type=244, Subtype=73, Switchtype=9, DeviceID=deviceID, Used=1).Create()
+
+    def reportMetrics(self, now):
+        elapsed = now - self.metricsTime
+        counters = metrics.registry.getCounterValues()
+        rates = {}
+        for name in counters:
+            rates[name] = (counters[name] - self.metricsCounters.get(name, 0)) / elapsed
+        latency = metrics.Histogram()
+        for name in sorted(metrics.registry.histograms):
+            h = metrics.registry.histograms[name]
+            if h.count:
+                _log.debug("{0}: {1} messages, mean {2:.3f}ms, p99 <= {3}ms", name, h.count, h.mean() * 1000, _ms(h.percentile(99)))
+            latency.merge(h)
+            h.reset()
+        p99 = latency.percentile(99)
+        _log.log("{0:.2f} msg/s, p99 latency <= {1}ms, {2:.2f} writes/s, {3:.2f} dropped msg/s",
+                 rates.get("messages", 0), _ms(p99), rates.get("writes", 0), rates.get("dropped", 0))
+        _log.debug("{0:.2f} repeated payloads/s, {1:.2f} duplicate values/s skipped", rates.get("repeats", 0), rates.get("duplicates", 0))
+        depth = metrics.registry.gauge("ingest.depth")
+        _log.log("Ingest queue depth {0}, max {1}, {2:.2f} overflowed msg/s", depth.value, depth.max, rates.get("ingest.dropped", 0))
+        depth.resetMax()
+        if self.metricsUnits:
+            values = {
+                "metrics.messages": rates.get("messages", 0),
+                "metrics.p99": (p99 or 0) * 1000,
+                "metrics.writes": rates.get("writes", 0),
+                "metrics.dropped": rates.get("dropped", 0),
+            }
+            for deviceID in values:
+                Unit = self.metricsUnits[deviceID]
+                if Unit in Devices:
+                    Devices[Unit].Update(0, format(values[deviceID], '.2f'))
+        self.metricsTime = now
+        self.metricsCounters = counters
 
     def doSubscribe(self, Connection):
-        Connection.Send({'Verb' : 'SUBSCRIBE', 'PacketIdentifier': 1001, 'Topics': [{'Topic':Parameters["Mode1"]+"/#", 'QoS': 0}]})
+        topics = [{'Topic': t, 'QoS': 0} for t in adapter.getSubscribeTopics(Parameters["Mode1"])]
+        Connection.Send({'Verb' : 'SUBSCRIBE', 'PacketIdentifier': 1001, 'Topics': topics})
 
     def doConnect(self):
         Protocol = "MQTT"
@@ -91,6 +397,12 @@ class BasePlugin:
         self.mqttConn = Domoticz.Connection(Name=PluginName, Transport="TCP/IP", Protocol=Protocol, Address=Parameters["Address"], Port=Parameters["Port"])
         self.mqttConn.Connect()
 
+
+def _ms(seconds):
+    if seconds is None:
+        return "-"
+    return format(seconds * 1000, 'g')
+
     
 global _plugin
 _plugin = BasePlugin()
@@ -107,6 +419,18 @@ def onMessage(Connection, Data):
     global _plugin
     _plugin.onMessage(Connection, Data)
 
+def onDeviceAdded(Unit):
+    global _plugin
+    _plugin.onDeviceAdded(Unit)
+
+def onDeviceModified(Unit):
+    global _plugin
+    _plugin.onDeviceModified(Unit)
+
+def onDeviceRemoved(Unit):
+    global _plugin
+    _plugin.onDeviceRemoved(Unit)
+
 def onDisconnect(Connection):
     global _plugin
     _plugin.onDisconnect(Connection)
@@ -115,11 +439,16 @@ def onHeartbeat():
     global _plugin
     _plugin.onHeartbeat()
 
+def onCommand(Unit, Command, Level, Hue):
+    global _plugin
+    _plugin.onCommand(Unit, Command, Level, Hue)
+
 def onNotification(Name, Subject, Text, Status, Priority, Sound, ImageFile):
     Domoticz.Log("onNotification called: "+Name+Subject+Text+Status)
 
 def onStop():
-    Domoticz.Log("onStop called")
+    global _plugin
+    _plugin.onStop()
 
 
     # Generic helper functions
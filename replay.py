@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Replay a capture file written by the plugin through adapter.onData.
+
+Domoticz devices recorded at the start of the capture are recreated in a
+mockdomoticz.Devices stand-in and the publishes are fed in order, either at
+recorded speed (scaled by --speed) or as fast as possible (--speed 0). The
+adapter clock follows the recorded timestamps and onHeartbeat is driven
+from them, so timers and write windows behave the same on every run and the
+final device state can be compared between versions. Pass the options the
+capture was taken with (--options, --write-window) to reproduce it.
+
+The plugin appends to the capture file, writing the devices again on every
+start. Such a block in the middle of a capture is replayed as a restart:
+the adapter is stopped and started again on the recorded devices.
+"""
+import argparse
+import json
+import sys
+import time
+import adapter
+import capture
+import mockdomoticz
+
+
+def loadCapture(path):
+    """
+    Returns the devices recorded at the start and the messages, a restart
+    with further device records is a (timestamp, None, records) message.
+    """
+    devices = mockdomoticz.Devices()
+    messages = []
+    records = []
+    for (kind, v) in list(capture.read(path)) + [("end", None)]:
+        if kind == "device":
+            records.append(v)
+            continue
+        if records:
+            if messages:
+                messages.append((messages[-1][0], None, records))
+            else:
+                setDevices(devices, records)
+            records = []
+        if kind == "message":
+            messages.append(v)
+    return (devices, messages)
+
+
+def setDevices(devices, records):
+    """
+    Replace the content of devices with the recorded devices.
+    """
+    devices.clear()
+    for v in records:
+        dev = mockdomoticz.Device(Name=v["DeviceID"], Unit=v["Unit"], Type=v["Type"], Subtype=v["SubType"], Switchtype=v["SwitchType"], DeviceID=v["DeviceID"], Used=1, devices=devices)
+        dev.nValue = v["nValue"]
+        dev.sValue = v["sValue"]
+        dev.BatteryLevel = v["BatteryLevel"]
+        dev.SignalLevel = v["SignalLevel"]
+        dev.Create()
+
+
+def replay(devices, messages, rootTopic, speed=0, heartbeat=10):
+    """
+    Feed messages into the adapter, returns wall clock seconds taken.
+    """
+    clock = [messages[0][0] if messages else 0]
+    savedClock = adapter._clock
+    adapter._clock = lambda: clock[0]
+    try:
+        adapter.onStart(devices)
+        start = time.perf_counter()
+        nextHeartbeat = clock[0] + heartbeat
+        for (ts, topic, payload) in messages:
+            while ts >= nextHeartbeat:
+                clock[0] = nextHeartbeat
+                adapter.onHeartbeat(nextHeartbeat)
+                nextHeartbeat += heartbeat
+            if speed > 0:
+                delay = (ts - messages[0][0]) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            clock[0] = ts
+            if topic is None:
+                # Plugin restart, replayed as a cold start as the capture
+                # holds no state snapshot
+                adapter.onStop()
+                adapter._timers = adapter.TimerQueue()
+                setDevices(devices, payload)
+                adapter.onStart(devices)
+                continue
+            adapter.onData(devices, devices.createDevice, rootTopic, topic, payload)
+        adapter.onStop()
+        return time.perf_counter() - start
+    finally:
+        adapter._clock = savedClock
+
+
+def compareStates(state, other):
+    differences = []
+    for deviceID in sorted(set(state) | set(other)):
+        a = state.get(deviceID)
+        b = other.get(deviceID)
+        if a != b:
+            differences.append("{0}: {1} != {2}".format(deviceID, a, b))
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("capture", help="capture file")
+    parser.add_argument("--root", default="AqaraHub", help="AqaraHub root topics, comma separated")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed relative to recording, 0 for as fast as possible")
+    parser.add_argument("--heartbeat", type=float, default=10, help="seconds between onHeartbeat calls")
+    parser.add_argument("--options", default="", help="adapter options, as the plugin Options parameter")
+    parser.add_argument("--write-window", type=int, default=0, help="write window in seconds, as the plugin parameter")
+    parser.add_argument("--state-out", help="write final device state as JSON")
+    parser.add_argument("--compare", help="compare final device state with JSON written by --state-out")
+    args = parser.parse_args()
+
+    try:
+        adapter.configure(args.options)
+    except ValueError as e:
+        parser.error(str(e))
+    adapter.setWriteWindow(args.write_window)
+    for warning in adapter.checkConfiguration():
+        print("Warning: " + warning, file=sys.stderr)
+    (devices, messages) = loadCapture(args.capture)
+    elapsed = replay(devices, messages, args.root, args.speed, args.heartbeat)
+    count = len([m for m in messages if m[1] is not None])
+    print("{0} messages in {1:.3f}s ({2:.0f}/s), {3} devices, {4} updates".format(
+        count, elapsed, count / elapsed if elapsed else 0, len(devices), devices.getUpdateCount()))
+
+    state = devices.getState()
+    if args.state_out:
+        with open(args.state_out, "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            other = dict([(k, tuple(v)) for (k, v) in json.load(f).items()])
+        differences = compareStates(state, other)
+        for d in differences:
+            print(d)
+        if differences:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
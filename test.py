@@ -2,6 +2,7 @@
 
 import unittest
 import adapter
+import metrics
 import time
 
 class TestTopic(unittest.TestCase):
@@ -30,6 +31,26 @@ class TestTopic(unittest.TestCase):
         self.assertEqual(t.getTopic(), "1/in/Temperature")
         self.assertEqual(t.getInTopic(), "Temperature")
 
+    def testShort(self):
+        t = adapter.Topic("AqaraHub", "AqaraHub")
+        self.assertEqual(t.getRootTopic(), "AqaraHub")
+        self.assertEqual(t.getDeviceID(), None)
+        self.assertEqual(t.getTopic(), None)
+        self.assertEqual(t.getInTopic(), None)
+
+    def testParsedOnce(self):
+        t1 = adapter.Topic("AqaraHub", "AqaraHub/XXYYCC/1/in/Temperature")
+        t2 = adapter.Topic("AqaraHub", "AqaraHub/XXYYCC/1/in/Temperature")
+        self.assertTrue(t1.getInTopic() is t2.getInTopic())
+        self.assertTrue(t1.getTopic() is t2.getTopic())
+
+
+    def testCacheSharedAcrossDevices(self):
+        adapter._parseSuffix.cache_clear()
+        for i in range(2000):
+            adapter.Topic("AqaraHub", "AqaraHub/DEV%d/1/in/OnOff/Report Attributes/OnOff" % i)
+        self.assertEqual(adapter._parseSuffix.cache_info().misses, 1)
+
 
 class TestGetSensorModel(unittest.TestCase):
 
@@ -51,6 +72,12 @@ class TestGetSensorModel(unittest.TestCase):
             m = adapter._getSensorModel(t, d)
             self.assertEqual(m, 'TH01')
 
+	def testReadAttributesFailure(self):
+            t = adapter.Topic("AqaraHub", "AqaraHub/XXYYCC/1/in/Basic/Read Attributes Response/ModelIdentifier")
+            d = '{"failure":134}'
+            m = adapter._getSensorModel(t, d)
+            self.assertEqual(m, None)
+
 
 _devices = {}
 
@@ -476,7 +503,26 @@ class TestMotionSensorAdapter(unittest.TestCase):
         proxy.update()
         self.assertEqual(dev.nValue, 1)
         self.assertEqual(len(adapter._timers), 1)
-        time.sleep(3)
+        adapter.onHeartbeat(time.time() + 1)
+        self.assertEqual(dev.nValue, 1)
+        adapter.onHeartbeat(time.time() + 3)
+        self.assertEqual(dev.nValue, 0)
+        self.assertEqual(proxy.value, 0)
+        self.assertEqual(len(adapter._timers), 0)
+
+    def testOffTimerRetriggered(self):
+        (devices, dev, proxy) = self.getMock()
+        proxy.motionTimeout = 2
+        adapter._allowTimers = True
+        now = time.time()
+        proxy.value = 1
+        proxy.update()
+        proxy.motionTimeout = 10
+        proxy.update()
+        self.assertEqual(len(adapter._timers), 1)
+        adapter.onHeartbeat(now + 3)
+        self.assertEqual(dev.nValue, 1)
+        adapter.onHeartbeat(now + 11)
         self.assertEqual(dev.nValue, 0)
         self.assertEqual(len(adapter._timers), 0)
         
@@ -741,5 +787,932 @@ class TestVibrationSensorAdapter(unittest.TestCase):
         self.assertEqual(dev.SignalLevel, 100)
 
 
+class TestDeadbands(unittest.TestCase):
+    def tearDown(self):
+        adapter._deadbands.clear()
+        adapter.setMaxSilence(30*60)
+        adapter._clock = time.time
+
+    def getMock(self):
+        dev = DeviceIDTHBMock()
+        calls = []
+        dev.Update = lambda nValue, sValue, BatteryLevel=None, SignalLevel=None: calls.append(sValue)
+        return (adapter.TempHumBaro({}, dev), calls)
+
+    def testUnchangedSuppressed(self):
+        (proxy, calls) = self.getMock()
+        proxy.update()
+        self.assertEqual(calls, [])
+        proxy.setTemperature(11.23)
+        proxy.update()
+        proxy.update()
+        self.assertEqual(calls, ["11.23;59.33;0;1024.01;0"])
+        proxy.signal = 5
+        proxy.update()
+        self.assertEqual(len(calls), 2)
+
+    def testDeadband(self):
+        adapter.configure("temperature=0.1; pressure = 0.2")
+        (proxy, calls) = self.getMock()
+        proxy.setTemperature(11.27)
+        proxy.setPressure(1024.11)
+        proxy.update()
+        self.assertEqual(calls, [])
+        proxy.setTemperature(11.34)
+        proxy.update()
+        self.assertEqual(calls, ["11.34;59.33;0;1024.11;0"])
+        proxy.setHumidity(59.34)
+        proxy.update()
+        self.assertEqual(len(calls), 2)
+
+    def testMaxSilence(self):
+        now = [1000]
+        adapter._clock = lambda: now[0]
+        adapter.configure("maxsilence=600")
+        (proxy, calls) = self.getMock()
+        proxy.update()
+        now[0] += 599
+        proxy.update()
+        self.assertEqual(calls, [])
+        now[0] += 1
+        proxy.update()
+        self.assertEqual(len(calls), 1)
+        proxy.update()
+        self.assertEqual(len(calls), 1)
+
+    def testTempHum(self):
+        adapter.configure("humidity=0.5")
+        dev = DeviceIDTHMock()
+        proxy = adapter.TempHum({}, dev)
+        proxy.setHumidity(59.7)
+        proxy.update()
+        self.assertEqual(dev.sValue, "11.22;59.33;0")
+        proxy.setHumidity(59.9)
+        proxy.update()
+        self.assertEqual(dev.sValue, "11.22;59.90;0")
+
+    def testUnknownOption(self):
+        with self.assertRaises(ValueError):
+            adapter.configure("temperatur=0.1")
+
+
+class TestMinWriteInterval(unittest.TestCase):
+    def setUp(self):
+        self.now = [1000]
+        adapter._clock = lambda: self.now[0]
+        adapter._timers = adapter.TimerQueue()
+
+    def tearDown(self):
+        adapter._clock = time.time
+        adapter._minWriteIntervals.clear()
+        adapter.XiaomiSensorWithBatteryAndLinkquality.MinWriteInterval = 0
+        adapter.TempHumBaro.MinWriteInterval = 0
+        adapter._timers = adapter.TimerQueue()
+
+    def testDelayedWrite(self):
+        adapter.configure("mininterval.TempHumBaro=60")
+        dev = DeviceIDTHBMock(DeviceID="00158D000272C69E")
+        proxy = adapter.TempHumBaro({}, dev)
+        t = adapter.Topic('AqaraHub', 'AqaraHub/00158D000272C69E/1/in/Temperature Measurement/Report Attributes/MeasuredValue')
+        proxy.processData(t, '{"type":"int16","value":2128}')
+        self.assertEqual(dev.sValue, "21.28;59.33;0;1024.01;0")
+        self.now[0] += 10
+        proxy.processData(t, '{"type":"int16","value":2130}')
+        self.now[0] += 10
+        proxy.processData(t, '{"type":"int16","value":2132}')
+        self.assertEqual(dev.sValue, "21.28;59.33;0;1024.01;0")
+        self.assertEqual(len(adapter._timers), 1)
+        adapter.onHeartbeat(self.now[0] + 39)
+        self.assertEqual(dev.sValue, "21.28;59.33;0;1024.01;0")
+        adapter.onHeartbeat(self.now[0] + 40)
+        self.assertEqual(dev.sValue, "21.32;59.33;0;1024.01;0")
+        self.assertEqual(len(adapter._timers), 0)
+
+    def testPerDevice(self):
+        adapter.configure("mininterval=60;mininterval.00158D00025EEA0D=0")
+        dev = DeviceIDDSMock(DeviceID="00158D00025EEA0D")
+        proxy = adapter.DoorSensor({}, dev)
+        t = adapter.Topic('AqaraHub', 'AqaraHub/00158D00025EEA0D/linkquality')
+        proxy.processData(t, '15')
+        proxy.processData(t, '25')
+        self.assertEqual(dev.SignalLevel, 2)
+
+    def testStateChangeExempt(self):
+        adapter.configure("mininterval=60")
+        dev = DeviceIDDSMock(DeviceID="00158D00025EEA0D")
+        proxy = adapter.DoorSensor({}, dev)
+        proxy.writtenTime = self.now[0]
+        lq = adapter.Topic('AqaraHub', 'AqaraHub/00158D00025EEA0D/linkquality')
+        onOff = adapter.Topic('AqaraHub', 'AqaraHub/00158D00025EEA0D/1/in/OnOff/Report Attributes/OnOff')
+        proxy.processData(lq, '15')
+        self.assertEqual(dev.SignalLevel, 100)
+        proxy.processData(onOff, '{"type":"bool","value":true}')
+        self.assertEqual(dev.nValue, 1)
+        self.assertEqual(dev.SignalLevel, 1)
+
+    def testMotionRetriggerWithinInterval(self):
+        adapter._allowTimers = True
+        adapter.configure("mininterval=300")
+        dev = DeviceIDMSMock(Unit=1, Type=244, Subtype=73, Switchtype=8, DeviceID="00158D0001DCD2A5")
+        proxy = adapter.MotionSensor({}, dev)
+        t = adapter.Topic('AqaraHub', 'AqaraHub/00158D0001DCD2A5/1/in/Occupancy Sensing/Report Attributes/Occupancy')
+        occupied = '{"type":"map8","value":[true,false,false,false,false,false,false,false]}'
+        proxy.processData(t, occupied)
+        self.assertEqual(dev.nValue, 1)
+        self.now[0] += 90
+        proxy.processData(t, occupied)
+        adapter.onHeartbeat(1120)
+        self.assertEqual(dev.nValue, 1)
+        adapter.onHeartbeat(1210)
+        self.assertEqual(dev.nValue, 0)
+
+    def testUnknownClassOrDevice(self):
+        adapter.configure("mininterval.XX=5")
+        self.assertEqual(adapter._minWriteIntervals["XX"], 5)
+        with self.assertRaises(ValueError):
+            adapter.configure("maxsilence.XX=5")
+
+
+class TestRepeats(unittest.TestCase):
+    def setUp(self):
+        self.now = [1000]
+        adapter._clock = lambda: self.now[0]
+
+    def tearDown(self):
+        adapter._clock = time.time
+
+    def testRepeatedPayload(self):
+        dev = DeviceIDDSMock(DeviceID="00158D00025EEA0D")
+        proxy = adapter.DoorSensor({}, dev)
+        t = adapter.Topic('AqaraHub', 'AqaraHub/00158D00025EEA0D/linkquality')
+        repeats = metrics.registry.counter("repeats").value
+        proxy.processData(t, '57')
+        dev.SignalLevel = 100
+        proxy.processData(t, '57')
+        self.assertEqual(dev.SignalLevel, 100)
+        self.assertEqual(metrics.registry.counter("repeats").value, repeats + 1)
+        self.now[0] += adapter._repeatWindow
+        proxy.processData(t, '57')
+        self.assertEqual(dev.SignalLevel, 5)
+
+    def testHashCollision(self):
+        class Payload(str):
+            def __hash__(self):
+                return 0
+
+        dev = DeviceIDDSMock(DeviceID="00158D00025EEA0D")
+        proxy = adapter.DoorSensor({}, dev)
+        t = adapter.Topic('AqaraHub', 'AqaraHub/00158D00025EEA0D/linkquality')
+        proxy.processData(t, Payload('57'))
+        proxy.processData(t, Payload('255'))
+        self.assertEqual(dev.SignalLevel, 25)
+
+    def testCrossPathDuplicate(self):
+        dev = DeviceIDDSMock(DeviceID="00158D00025EEA0D")
+        proxy = adapter.DoorSensor({}, dev)
+        onOff = adapter.Topic('AqaraHub', 'AqaraHub/00158D00025EEA0D/1/in/OnOff/Report Attributes/OnOff')
+        xiaomi = adapter.Topic('AqaraHub', 'AqaraHub/00158D00025EEA0D/1/in/Basic/Report Attributes/0xFF01')
+        duplicates = metrics.registry.counter("duplicates").value
+        proxy.processData(onOff, '{"type":"bool","value":true}')
+        self.assertEqual(dev.nValue, 1)
+        proxy.processData(xiaomi, '{"type":"xiaomi_ff01","value":{"100":{"type":"bool","value":true}}}')
+        self.assertEqual(metrics.registry.counter("duplicates").value, duplicates + 1)
+        proxy.processData(xiaomi, '{"type":"xiaomi_ff01","value":{"100":{"type":"bool","value":false}}}')
+        self.assertEqual(dev.nValue, 0)
+        self.assertEqual(metrics.registry.counter("duplicates").value, duplicates + 1)
+
+    def testOptions(self):
+        adapter.configure("repeatwindow=0;duplicatewindow=2")
+        try:
+            self.assertEqual(adapter._repeatWindow, 0)
+            self.assertEqual(adapter._duplicateWindow, 2)
+        finally:
+            adapter.configure("repeatwindow=10;duplicatewindow=5")
+
+
+class TestAggregation(unittest.TestCase):
+    def setUp(self):
+        self.now = [1000]
+        adapter._clock = lambda: self.now[0]
+        adapter._timers = adapter.TimerQueue()
+
+    def tearDown(self):
+        adapter._clock = time.time
+        adapter._aggregation.clear()
+        adapter.TempHumBaro.MinWriteInterval = 0
+        adapter._timers = adapter.TimerQueue()
+
+    def testMeanPerWindow(self):
+        adapter.configure("aggregate.temperature=mean;mininterval.TempHumBaro=60")
+        dev = DeviceIDTHBMock(DeviceID="00158D000272C69E")
+        proxy = adapter.TempHumBaro({}, dev)
+        t = adapter.Topic('AqaraHub', 'AqaraHub/00158D000272C69E/1/in/Temperature Measurement/Report Attributes/MeasuredValue')
+        proxy.processData(t, '{"type":"int16","value":2000}')
+        self.assertEqual(dev.sValue, "20.00;59.33;0;1024.01;0")
+        for v in (2100, 2300):
+            self.now[0] += 10
+            proxy.processData(t, '{"type":"int16","value":%d}' % v)
+        self.assertEqual(dev.sValue, "20.00;59.33;0;1024.01;0")
+        adapter.onHeartbeat(self.now[0] + 40)
+        self.assertEqual(dev.sValue, "22.00;59.33;0;1024.01;0")
+
+    def testWindowResetWhenSuppressed(self):
+        adapter.configure("aggregate.temperature=mean;mininterval.TempHumBaro=60;temperature=0.5")
+        try:
+            dev = DeviceIDTHBMock(DeviceID="00158D000272C69E")
+            proxy = adapter.TempHumBaro({}, dev)
+            t = adapter.Topic('AqaraHub', 'AqaraHub/00158D000272C69E/1/in/Temperature Measurement/Report Attributes/MeasuredValue')
+            proxy.processData(t, '{"type":"int16","value":2000}')
+            for v in (2010, 2020):
+                self.now[0] += 10
+                proxy.processData(t, '{"type":"int16","value":%d}' % v)
+            adapter.onHeartbeat(1060)
+            self.assertEqual(dev.sValue, "20.00;59.33;0;1024.01;0")
+            self.now[0] = 1070
+            proxy.processData(t, '{"type":"int16","value":2100}')
+            self.assertEqual(dev.sValue, "21.00;59.33;0;1024.01;0")
+        finally:
+            adapter._deadbands.clear()
+
+    def testWarning(self):
+        adapter.configure("aggregate=mean")
+        self.assertEqual(len(adapter.checkConfiguration()), 1)
+        adapter.configure("mininterval.TempHumBaro=60")
+        self.assertEqual(adapter.checkConfiguration(), [])
+
+    def testModes(self):
+        for (mode, expected) in (("mean", 2.0), ("last", 1.0), ("min", 1.0), ("max", 3.0)):
+            a = adapter.Aggregator(mode)
+            for v in (2.0, 3.0, 1.0):
+                r = a.add(v)
+            self.assertEqual(r, expected)
+        a.reset()
+        self.assertEqual(a.add(5.0), 5.0)
+
+    def testOptions(self):
+        adapter.configure("aggregate=max;aggregate.pressure=last")
+        self.assertEqual(adapter._aggregation, {"temperature": "max", "humidity": "max", "pressure": "last"})
+        with self.assertRaises(ValueError):
+            adapter.configure("aggregate.temperature=median")
+
+
+class TestModelRegistry(unittest.TestCase):
+    def testModels(self):
+        self.assertTrue(adapter._models["lumi.weather"] is adapter.TempHumBaro)
+        self.assertTrue(adapter._models["lumi.sensor_motion.aq2"] is adapter.MotionSensor)
+        self.assertTrue(adapter._models["lumi.sensor_magnet.aq2"] is adapter.DoorSensor)
+        self.assertTrue(adapter._models["lumi.vibration.aq1"] is adapter.VibrationSensor)
+        self.assertTrue(adapter._models["TH01"] is adapter.TempHum)
+
+    def testReadAttributesResponse(self):
+        global _devices
+
+        _devices = {}
+        topic = 'AqaraHub/00124B00226A2C3B/1/in/Basic/Read Attributes Response/ModelIdentifier'
+        adapter.onData(_devices, DeviceIDTHMock, 'AqaraHub', topic, '{"success":{"type":"string","value":"TH01"}}')
+        self.assertEqual(len(_devices), 1)
+        self.assertEqual(_devices[1].DeviceID, "00124B00226A2C3B")
+        self.assertEqual(_devices[1].TypeName, "Temp+Hum")
+
+
+class TestUnknownDevices(unittest.TestCase):
+    def testPendingDiscovery(self):
+        devices = {}
+        root = 'AqaraHub/00158D0002786756/'
+        adapter.onData(devices, DeviceIDTHBMock, 'AqaraHub', root+'linkquality', '18')
+        unknown = adapter._getDeviceIndex(devices).getHub('AqaraHub').unknown
+        self.assertEqual(unknown.getState("00158D0002786756"), adapter.UnknownDevices.Pending)
+        requests = adapter.getDiscoveryRequests(devices, 'AqaraHub', 1000)
+        self.assertEqual(requests, [(root+'1/out/Basic/Read Attributes', '["ModelIdentifier"]')])
+        self.assertEqual(adapter.getDiscoveryRequests(devices, 'AqaraHub', 1001), [])
+        self.assertEqual(len(adapter.getDiscoveryRequests(devices, 'AqaraHub', 1000 + unknown.DiscoveryRetry)), 1)
+
+    def testFailedRead(self):
+        devices = {}
+        root = 'AqaraHub/00158D0002786756/'
+        adapter.onData(devices, DeviceIDTHBMock, 'AqaraHub', root+'1/in/Basic/Read Attributes Response/ModelIdentifier', '{"failure":134}')
+        unknown = adapter._getDeviceIndex(devices).getHub('AqaraHub').unknown
+        self.assertEqual(unknown.getState("00158D0002786756"), adapter.UnknownDevices.Pending)
+        self.assertEqual(len(adapter.getDiscoveryRequests(devices, 'AqaraHub', 1000)), 1)
+
+    def testRateLimited(self):
+        devices = {}
+        for i in range(5):
+            adapter.onData(devices, DeviceIDTHBMock, 'AqaraHub', 'AqaraHub/DEV'+str(i)+'/linkquality', '18')
+        unknown = adapter._getDeviceIndex(devices).getHub('AqaraHub').unknown
+        self.assertEqual(len(adapter.getDiscoveryRequests(devices, 'AqaraHub', 0)), unknown.DiscoveriesPerCall)
+
+    def testRegisteredAfterResponse(self):
+        global _devices
+
+        _devices = {}
+        root = 'AqaraHub/00158D0002786756/'
+        adapter.onData(_devices, DeviceIDTHBMock, 'AqaraHub', root+'linkquality', '18')
+        adapter.onData(_devices, DeviceIDTHBMock, 'AqaraHub', root+'1/in/Basic/Read Attributes Response/ModelIdentifier', '{"success":{"type":"string","value":"lumi.weather"}}')
+        self.assertEqual(len(_devices), 1)
+        unknown = adapter._getDeviceIndex(_devices).getHub('AqaraHub').unknown
+        self.assertEqual(unknown.getState("00158D0002786756"), None)
+        self.assertEqual(adapter.getDiscoveryRequests(_devices, 'AqaraHub', 0), [])
+
+    def testUnsupported(self):
+        devices = {}
+        root = 'AqaraHub/00158D0002786756/'
+        adapter.onData(devices, DeviceIDTHBMock, 'AqaraHub', root+'1/in/Basic/Report Attributes/ModelIdentifier', '{"type":"string","value":"lumi.XXXXX"}')
+        adapter.onData(devices, DeviceIDTHBMock, 'AqaraHub', root+'linkquality', '18')
+        unknown = adapter._getDeviceIndex(devices).getHub('AqaraHub').unknown
+        self.assertEqual(unknown.getState("00158D0002786756"), adapter.UnknownDevices.Unsupported)
+        self.assertEqual(adapter.getDiscoveryRequests(devices, 'AqaraHub', 0), [])
+
+    def testPerHub(self):
+        devices = {}
+        adapter.onData(devices, DeviceIDTHBMock, 'Hub1, Hub2', 'Hub2/00158D0002786756/linkquality', '18')
+        adapter.onData(devices, DeviceIDTHBMock, 'Hub1, Hub2', 'Hub3/00158D0002786757/linkquality', '18')
+        index = adapter._getDeviceIndex(devices)
+        self.assertEqual(len(index.getHub('Hub1').unknown), 0)
+        self.assertEqual(len(index.getHub('Hub2').unknown), 1)
+        self.assertEqual(len(index.getHub('Hub3').unknown), 0)
+        requests = adapter.getDiscoveryRequests(devices, 'Hub1, Hub2', 0)
+        self.assertEqual(requests, [('Hub2/00158D0002786756/1/out/Basic/Read Attributes', '["ModelIdentifier"]')])
+
+    def testBounded(self):
+        unknown = adapter.UnknownDevices()
+        for i in range(unknown.MaxSize + 10):
+            unknown.addPending(str(i))
+        self.assertEqual(len(unknown), unknown.MaxSize)
+        self.assertEqual(unknown.getState("0"), None)
+
+
+class TestWriteCoalescing(unittest.TestCase):
+    def tearDown(self):
+        adapter.setWriteWindow(0)
+
+    def testCoalesced(self):
+        global _devices
+
+        _devices = {}
+        dev = DeviceIDTHBMock(Unit=1, DeviceID="00158D000272C69E")
+        dev.Create()
+        adapter.onStart(_devices)
+        adapter.setWriteWindow(5)
+        calls = []
+        dev.Update = lambda nValue, sValue, BatteryLevel=None, SignalLevel=None: calls.append(sValue)
+        root = 'AqaraHub/00158D000272C69E/1/in/'
+        adapter.onData(_devices, DeviceIDTHBMock, 'AqaraHub', root+'Temperature Measurement/Report Attributes/MeasuredValue', '{"type":"int16","value":2128}')
+        adapter.onData(_devices, DeviceIDTHBMock, 'AqaraHub', root+'Relative Humidity Measurement/Report Attributes/MeasuredValue', '{"type":"uint16","value":3947}')
+        self.assertEqual(calls, [])
+        adapter.onHeartbeat(adapter._lastFlush + 1)
+        self.assertEqual(calls, [])
+        adapter.onHeartbeat(adapter._lastFlush + 5)
+        self.assertEqual(calls, ["21.28;39.47;0;1024.01;0"])
+        adapter.onHeartbeat(adapter._lastFlush + 5)
+        self.assertEqual(len(calls), 1)
+
+    def testImmediate(self):
+        adapter.setWriteWindow(5)
+        dev = DeviceIDDSMock()
+        proxy = adapter.DoorSensor({}, dev)
+        t = adapter.Topic('AqaraHub', 'AqaraHub/00158D00025EEA0D/1/in/OnOff/Report Attributes/OnOff')
+        proxy.processData(t, '{"type":"bool","value":true}')
+        self.assertEqual(dev.nValue, 1)
+        self.assertEqual(len(adapter._dirty), 0)
+
+
+class TestDeviceIndex(unittest.TestCase):
+    def getDevices(self):
+        devices = {}
+        for (u, i) in ((1, "AAA"), (2, "BBB"), (5, "CCC")):
+            devices[u] = DeviceIDMSMock(Unit=u, DeviceID=i)
+        return devices
+
+    def testLookup(self):
+        devices = self.getDevices()
+        index = adapter.DeviceIndex(devices)
+        self.assertEqual(index.getUnit("AAA"), 1)
+        self.assertEqual(index.getUnit("CCC"), 5)
+        self.assertEqual(index.getUnit("XXX"), None)
+
+    def testAddRemove(self):
+        devices = self.getDevices()
+        index = adapter.DeviceIndex(devices)
+        devices[7] = DeviceIDMSMock(Unit=7, DeviceID="DDD")
+        index.add(7)
+        self.assertEqual(index.getUnit("DDD"), 7)
+        del devices[2]
+        index.remove(2)
+        self.assertEqual(index.getUnit("BBB"), None)
+        self.assertEqual(index.getUnit("AAA"), 1)
+
+    def testChangedBehindOurBack(self):
+        devices = self.getDevices()
+        index = adapter.DeviceIndex(devices)
+        devices[9] = DeviceIDMSMock(Unit=9, DeviceID="EEE")
+        self.assertEqual(index.getUnit("EEE"), 9)
+        devices[1].DeviceID = "FFF"
+        self.assertEqual(index.getUnit("AAA"), None)
+        self.assertEqual(index.getUnit("FFF"), 1)
+
+    def testAllocateUnit(self):
+        devices = self.getDevices()
+        index = adapter.DeviceIndex(devices)
+        self.assertEqual(index.allocateUnit(), 3)
+        devices[3] = DeviceIDMSMock(Unit=3, DeviceID="DDD")
+        index.add(3)
+        self.assertEqual(index.allocateUnit(), 4)
+        self.assertEqual(index.allocateUnit(), 6)
+        del devices[1]
+        index.remove(1)
+        self.assertEqual(index.allocateUnit(), 1)
+
+    def testAllocateUnitExhausted(self):
+        devices = {}
+        for u in range(1, adapter.MaxUnit):
+            devices[u] = DeviceIDMSMock(Unit=u, DeviceID=str(u))
+        index = adapter.DeviceIndex(devices)
+        self.assertEqual(index.allocateUnit(), adapter.MaxUnit)
+        with self.assertRaises(adapter.NoFreeUnitError):
+            index.allocateUnit()
+
+    def testDeviceProxy(self):
+        devices = self.getDevices()
+        devices[5] = DeviceIDMSMock(Unit=5, Type=244, Subtype=73, Switchtype=8, DeviceID="CCC")
+        adapter.onStart(devices)
+        self.assertTrue(isinstance(adapter._getDeviceProxy(devices, "CCC"), adapter.MotionSensor))
+        self.assertEqual(adapter._getDeviceProxy(devices, "AAA"), None)
+        self.assertEqual(adapter._getDeviceProxy(devices, "XXX"), None)
+
+    def testAdapterCached(self):
+        devices = self.getDevices()
+        devices[5] = DeviceIDMSMock(Unit=5, Type=244, Subtype=73, Switchtype=8, DeviceID="CCC")
+        adapter.onStart(devices)
+        proxy = adapter._getDeviceProxy(devices, "CCC")
+        self.assertTrue(adapter._getDeviceProxy(devices, "CCC") is proxy)
+        devices[5].SwitchType = 11
+        adapter.onDeviceModified(devices, 5)
+        other = adapter._getDeviceProxy(devices, "CCC")
+        self.assertTrue(isinstance(other, adapter.DoorSensor))
+        devices[5] = DeviceIDMSMock(Unit=5, Type=244, Subtype=73, Switchtype=11, DeviceID="CCC")
+        self.assertFalse(adapter._getDeviceProxy(devices, "CCC") is other)
+        del devices[5]
+        adapter.onDeviceRemoved(devices, 5)
+        self.assertEqual(adapter._getDeviceProxy(devices, "CCC"), None)
+
+
+class TestRoutes(unittest.TestCase):
+    def testRouteKey(self):
+        t = adapter.Topic("AqaraHub", "AqaraHub/XXYYCC/linkquality")
+        self.assertEqual(t.getRouteKey(), "linkquality")
+        t = adapter.Topic("AqaraHub", "AqaraHub/XXYYCC/1/in/OnOff/Report Attributes/OnOff")
+        self.assertEqual(t.getRouteKey(), "OnOff/Report Attributes/OnOff")
+
+    def testCompiled(self):
+        self.assertTrue("Pressure Measurement/Report Attributes/ScaledValue" in adapter.TempHumBaro.Routes)
+        self.assertTrue(adapter.XiaomiTopic in adapter.DoorSensor.Routes)
+        self.assertFalse(adapter.XiaomiTopic in adapter.TempHum.Routes)
+        self.assertFalse("Pressure Measurement/Report Attributes/ScaledValue" in adapter.DoorSensor.Routes)
+        self.assertTrue("Pressure Measurement/Report Attributes/ScaledValue" in adapter._consumedTopics)
+        for t in adapter.ModelTopics:
+            self.assertTrue(t in adapter._consumedTopics)
+
+    def testSubscribeTopics(self):
+        topics = adapter.getSubscribeTopics("AqaraHub")
+        self.assertTrue("AqaraHub/+/linkquality" in topics)
+        self.assertTrue("AqaraHub/+/+/in/Basic/Report Attributes/0xFF01" in topics)
+        self.assertTrue("AqaraHub/+/+/in/Basic/Read Attributes Response/ModelIdentifier" in topics)
+        self.assertTrue("AqaraHub/+/+/in/Occupancy Sensing/Report Attributes/Occupancy" in topics)
+        self.assertEqual(len(topics), len(set(topics)))
+        for t in topics:
+            self.assertTrue(adapter.Topic("AqaraHub", t.replace("+", "X")).getRouteKey() in adapter._consumedTopics)
+
+    def testMultipleHubs(self):
+        topics = adapter.getSubscribeTopics("Hub1,Hub2")
+        self.assertTrue("Hub1/+/linkquality" in topics)
+        self.assertTrue("Hub2/+/linkquality" in topics)
+        self.assertEqual(len(topics), 2 * len(adapter.getSubscribeTopics("Hub1")))
+        t = adapter.Topic("Hub1, Hub2", "Hub2/XXYYCC/linkquality")
+        self.assertTrue(t.checkRootTopic())
+        t = adapter.Topic("Hub1, Hub2", "Hub3/XXYYCC/linkquality")
+        self.assertFalse(t.checkRootTopic())
+
+    def testRoutedByHub(self):
+        global _devices
+
+        _devices = {}
+        model = '/1/in/Basic/Report Attributes/ModelIdentifier'
+        adapter.onData(_devices, DeviceIDTHBMock, 'Hub1,Hub2', 'Hub2/00158D0002786756'+model, '{"type":"string","value":"lumi.weather"}')
+        adapter.onData(_devices, DeviceIDTHBMock, 'Hub1,Hub2', 'Hub3/00158D0002786757'+model, '{"type":"string","value":"lumi.weather"}')
+        self.assertEqual(len(_devices), 1)
+        self.assertEqual(_devices[1].DeviceID, "00158D0002786756")
+
+    def testRawPayload(self):
+        global _devices
+
+        _devices = {}
+        adapter.onData(_devices, DeviceIDTHBMock, 'AqaraHub', 'AqaraHub/00158D0002786756/1/in/Basic/Report Attributes/ModelIdentifier', b'{"type":"string","value":"lumi.weather"}')
+        self.assertEqual(len(_devices), 1)
+        adapter.onData(_devices, DeviceIDTHBMock, 'AqaraHub', 'AqaraHub/00158D0002786756/1/in/Temperature Measurement/Report Attributes/MeasuredValue', b'{"type":"int16","value":2128}')
+        adapter.onData(_devices, DeviceIDTHBMock, 'AqaraHub', 'AqaraHub/00158D0002786756/linkquality', b'57')
+        self.assertEqual(_devices[1].sValue, "21.28;59.33;0;1024.01;0")
+        self.assertEqual(_devices[1].SignalLevel, 5)
+
+    def testSingleXiaomiUpdate(self):
+        import mockdomoticz
+
+        devices = mockdomoticz.Devices()
+        devices.createDevice(Name="THB", Unit=1, TypeName="Temp+Hum+Baro", DeviceID="00158D0002786756", Used=1).Create()
+        topic = 'AqaraHub/00158D0002786756/1/in/Basic/Report Attributes/0xFF01'
+        data = '{"type":"xiaomi_ff01","value":{"1":{"type":"uint16","value":3005},"100":{"type":"int16","value":2128},"101":{"type":"uint16","value":5933},"102":{"type":"int32","value":102401}}}'
+        adapter.onData(devices, devices.createDevice, 'AqaraHub', topic, data)
+        self.assertEqual(devices[1].updateCount, 1)
+        self.assertEqual(devices[1].sValue, "21.28;59.33;0;1024.01;0")
+
+    def testConverters(self):
+        scale = adapter._compileConverter(0.01)
+        self.assertEqual(scale("int16", 2128), 21.28)
+        self.assertEqual(scale("string", "2128"), 21.28)
+        self.assertEqual(scale(None, 2128), 21.28)
+        self.assertEqual(adapter._compileConverter("bool")("uint8", 1), True)
+        self.assertEqual(adapter._compileConverter("map8")("map8", [True, False]), True)
+        self.assertEqual(adapter._compileConverter("map8")("uint8", 2), False)
+
+    def testCompiledPerClass(self):
+        self.assertTrue(adapter.TempHum.Routes[adapter.LinkQualityTopic] is adapter._linkQualityHandler)
+        self.assertFalse(adapter.XiaomiTopic in adapter.TempHum.Routes)
+        self.assertEqual(adapter.XiaomiSensorWithBatteryAndLinkquality.Routes, {})
+
+    def testUnconsumedNotParsed(self):
+        devices = {}
+        adapter.onData(devices, DeviceIDTHBMock, 'AqaraHub', 'AqaraHub/XXYYCC/1/in/XX/YY', 'not json')
+        self.assertEqual(len(devices), 0)
+
+
+class TestMetrics(unittest.TestCase):
+    def testHistogram(self):
+        h = metrics.Histogram((0.001, 0.01, 0.1))
+        self.assertEqual(h.percentile(99), None)
+        for i in range(98):
+            h.observe(0.0005)
+        h.observe(0.005)
+        h.observe(0.05)
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.percentile(50), 0.001)
+        self.assertEqual(h.percentile(99), 0.01)
+        self.assertEqual(h.percentile(100), 0.1)
+        h.observe(5)
+        self.assertEqual(h.percentile(100), 5)
+        h.observe(2)
+        self.assertEqual(h.percentile(100), 5)
+        merged = metrics.Histogram((0.001, 0.01, 0.1))
+        merged.observe(7)
+        merged.merge(h)
+        self.assertEqual(merged.max, 7)
+        self.assertEqual(merged.percentile(99), 7)
+        h.reset()
+        self.assertEqual(h.count, 0)
+        self.assertEqual(h.max, None)
+
+    def testOnDataCounters(self):
+        dev = DeviceIDDSMock(Unit=1, Type=244, Subtype=73, Switchtype=11, DeviceID="00158D00025EEA0D")
+        devices = {1: dev}
+        before = metrics.registry.getCounterValues()
+        latency = metrics.registry.histograms["latency.DoorSensor"]
+        count = latency.count
+        root = 'AqaraHub/00158D00025EEA0D/'
+        adapter.onData(devices, DeviceIDDSMock, 'AqaraHub', root+'1/in/OnOff/Report Attributes/OnOff', '{"type":"bool","value":true}')
+        adapter.onData(devices, DeviceIDDSMock, 'AqaraHub', root+'1/in/XX/YY', '10')
+        after = metrics.registry.getCounterValues()
+        self.assertEqual(after["messages"] - before["messages"], 2)
+        self.assertEqual(after["dropped"] - before["dropped"], 1)
+        self.assertEqual(after["writes"] - before["writes"], 1)
+        self.assertEqual(latency.count, count + 1)
+
+
+class TestBench(unittest.TestCase):
+    def testRunFleet(self):
+        import bench
+
+        r = bench.runFleet(20, 500, 1)
+        self.assertEqual(r["devices"], 20)
+        self.assertTrue(r["rate"] > 0)
+        self.assertTrue(r["p50"] <= r["p99"] <= r["max"])
+        self.assertTrue(r["updates"] > 0)
+        self.assertTrue(r["B/dev"] > 0)
+
+    def testSlotted(self):
+        import bench
+
+        devices = bench.buildFleet(len(bench.Kinds))
+        index = adapter._getDeviceIndex(devices)
+        for Unit in devices:
+            a = index.getAdapter(Unit)
+            self.assertFalse(hasattr(a, "__dict__"))
+            self.assertFalse(hasattr(a, "devices"))
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        adapter._allowTimers = True
+
+    def tearDown(self):
+        adapter._timers = adapter.TimerQueue()
+
+    def testWarmStart(self):
+        import os
+        import tempfile
+
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(path)
+        try:
+            self.assertFalse(adapter.loadSnapshot({}, path))
+            devices = {1: DeviceIDMSMock(Unit=1, Type=244, Subtype=73, Switchtype=8, DeviceID="00158D0001DCD2A5")}
+            root = 'AqaraHub/00158D0001DCD2A5/'
+            adapter.onData(devices, DeviceIDMSMock, 'AqaraHub', root+'1/in/Occupancy Sensing/Report Attributes/Occupancy', '{"type":"map8","value":[true,false,false,false,false,false,false,false]}')
+            adapter.onData(devices, DeviceIDMSMock, 'AqaraHub', 'AqaraHub/00158D0002786756/linkquality', '18')
+            deadline = adapter._timers.timers["00158D0001DCD2A5"][0]
+            adapter.saveSnapshot(devices, path)
+
+            adapter._timers = adapter.TimerQueue()
+            devices = {1: DeviceIDMSMock(Unit=1, Type=244, Subtype=73, Switchtype=8, DeviceID="00158D0001DCD2A5")}
+            devices[1].nValue = 1
+            devices[1].BatteryLevel = 42
+            self.assertTrue(adapter.loadSnapshot(devices, path))
+            index = adapter._getDeviceIndex(devices)
+            proxy = index.getAdapter(1)
+            self.assertEqual(proxy.value, 1)
+            self.assertEqual(proxy.batt, 42)
+            self.assertEqual(proxy.written, None)
+            self.assertTrue(proxy.lastSeen is not None)
+            self.assertEqual(adapter._timers.timers["00158D0001DCD2A5"][0], deadline)
+            self.assertEqual(index.getHub('AqaraHub').unknown.getState("00158D0002786756"), adapter.UnknownDevices.Pending)
+            adapter.onHeartbeat(deadline)
+            self.assertEqual(devices[1].nValue, 0)
+
+            # Switched off while the plugin was stopped, no timer to restore
+            adapter._timers = adapter.TimerQueue()
+            devices = {1: DeviceIDMSMock(Unit=1, Type=244, Subtype=73, Switchtype=8, DeviceID="00158D0001DCD2A5")}
+            self.assertTrue(adapter.loadSnapshot(devices, path))
+            self.assertEqual(adapter._timers.timers, {})
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TestIngest(unittest.TestCase):
+    def testOrdering(self):
+        import ingest
+
+        seen = []
+        q = ingest.IngestQueue(lambda topic, payload: seen.append((topic, payload)), batchSize=3)
+        q.start()
+        for i in range(10):
+            q.put("Dev"+str(i % 2), i)
+        self.assertTrue(q.drain(5))
+        q.stop(5)
+        self.assertEqual([p for (t, p) in seen if t == "Dev0"], [0, 2, 4, 6, 8])
+        self.assertEqual([p for (t, p) in seen if t == "Dev1"], [1, 3, 5, 7, 9])
+
+    def testOverflow(self):
+        import ingest
+
+        dropped = metrics.registry.counter("ingest.dropped").value
+        q = ingest.IngestQueue(None, maxSize=2, policy=ingest.DropNewest)
+        self.assertTrue(q.put("A", 1))
+        self.assertTrue(q.put("A", 2))
+        self.assertFalse(q.put("A", 3))
+        self.assertEqual(list(q.messages), [("A", 1), ("A", 2)])
+        q = ingest.IngestQueue(None, maxSize=2, policy=ingest.DropOldest)
+        for i in range(3):
+            q.put("A", i)
+        self.assertEqual(list(q.messages), [("A", 1), ("A", 2)])
+        self.assertEqual(metrics.registry.counter("ingest.dropped").value, dropped + 2)
+        self.assertEqual(metrics.registry.gauge("ingest.depth").max >= 2, True)
+
+    def testErrors(self):
+        import ingest
+
+        errors = []
+        def process(topic, payload):
+            if payload == 1:
+                raise KeyError(payload)
+        q = ingest.IngestQueue(process, onError=lambda topic, payload, e: errors.append(payload))
+        q.start()
+        for i in range(3):
+            q.put("A", i)
+        q.stop(5)
+        self.assertEqual(errors, [1])
+        self.assertEqual(len(q), 0)
+
+
+class TestDeferredWrites(unittest.TestCase):
+    def tearDown(self):
+        adapter.setDeferWrites(False)
+        adapter._pending.clear()
+
+    def testFlushPending(self):
+        adapter.setDeferWrites(True)
+        dev = DeviceIDDSMock(DeviceID="00158D00025EEA0D")
+        proxy = adapter.DoorSensor({}, dev)
+        t = adapter.Topic('AqaraHub', 'AqaraHub/00158D00025EEA0D/1/in/OnOff/Report Attributes/OnOff')
+        proxy.processData(t, '{"type":"bool","value":true}')
+        self.assertEqual(dev.nValue, 0)
+        adapter.flushPending()
+        self.assertEqual(dev.nValue, 1)
+
+    def testRegistrationHandedBack(self):
+        devices = {}
+        topic = 'AqaraHub/00158D0002786756/1/in/Basic/Report Attributes/ModelIdentifier'
+        data = '{"type":"string","value":"lumi.weather"}'
+        self.assertFalse(adapter.onData(devices, None, 'AqaraHub', topic, data))
+        self.assertEqual(len(devices), 0)
+        self.assertTrue(adapter.onData(devices, None, 'AqaraHub', 'AqaraHub/00158D0002786756/linkquality', '18'))
+
+
+class TestCaptureReplay(unittest.TestCase):
+    def testRoundTrip(self):
+        import os
+        import tempfile
+        import capture
+        import replay
+
+        devices = {1: DeviceIDMSMock(Unit=1, Type=244, Subtype=73, Switchtype=11, DeviceID="00158D00025EEA0D")}
+        root = 'AqaraHub/00158D00025EEA0D/'
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            w = capture.CaptureWriter(path)
+            w.writeDevices(devices)
+            w.writeMessage(100.0, root+'1/in/OnOff/Report Attributes/OnOff', b'{"type":"bool","value":true}')
+            w.writeMessage(101.5, root+'linkquality', b'\xff')
+            w.writeMessage(102.0, root+'linkquality', b'57')
+            w.close()
+            records = list(capture.read(path))
+            self.assertEqual(records[0][0], "device")
+            self.assertEqual(records[2][1], (101.5, root+'linkquality', b'\xff'))
+
+            (replayDevices, messages) = replay.loadCapture(path)
+            del messages[1]
+            replay.replay(replayDevices, messages, 'AqaraHub')
+            self.assertEqual(replayDevices.getState()["00158D00025EEA0D"], (1, "", 255, 5))
+            self.assertEqual(replay.compareStates(replayDevices.getState(), replayDevices.getState()), [])
+        finally:
+            os.remove(path)
+
+
+    def testRestart(self):
+        import os
+        import tempfile
+        import capture
+        import replay
+
+        root = 'AqaraHub/00158D00025EEA0D/'
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            devices = {1: DeviceIDMSMock(Unit=1, Type=244, Subtype=73, Switchtype=11, DeviceID="00158D00025EEA0D")}
+            w = capture.CaptureWriter(path)
+            w.writeDevices(devices)
+            w.writeMessage(100.0, root+'1/in/OnOff/Report Attributes/OnOff', b'{"type":"bool","value":true}')
+            w.close()
+            devices[1].nValue = 1
+            devices[1].SignalLevel = 7
+            w = capture.CaptureWriter(path)
+            w.writeDevices(devices)
+            w.writeMessage(200.0, root+'1/in/OnOff/Report Attributes/OnOff', b'{"type":"bool","value":false}')
+            w.close()
+
+            (replayDevices, messages) = replay.loadCapture(path)
+            self.assertEqual(len(messages), 3)
+            self.assertEqual(messages[1][1], None)
+            self.assertEqual(replayDevices[1].nValue, 0)
+            replay.replay(replayDevices, messages, 'AqaraHub')
+            self.assertEqual(replayDevices.getState()["00158D00025EEA0D"], (0, "", 255, 7))
+        finally:
+            os.remove(path)
+
+
+class TestBridge(unittest.TestCase):
+    def testBridge(self):
+        import asyncio
+        import json
+        import bridge
+        import mqtt
+
+        async def run():
+            broker = mqtt.Broker()
+            port = await broker.start()
+            client = mqtt.Client()
+            await client.connect("127.0.0.1", port, "bridge")
+            b = bridge.Bridge(client, "AqaraHub", "out", heartbeat=60)
+            task = asyncio.ensure_future(b.run())
+
+            received = []
+            listener = mqtt.Client()
+            await listener.connect("127.0.0.1", port, "listener")
+            listener.subscribe(["out/#"])
+            listening = asyncio.ensure_future(listener.run(lambda t, p: received.append((t, json.loads(p)))))
+            await asyncio.sleep(0.1)
+
+            root = 'AqaraHub/00158D0002786756/1/in/'
+            broker.publish(root+'Basic/Report Attributes/ModelIdentifier', '{"type":"string","value":"lumi.weather"}')
+            broker.publish(root+'Temperature Measurement/Report Attributes/MeasuredValue', 'not json')
+            broker.publish(root+'Temperature Measurement/Report Attributes/MeasuredValue', '{"type":"int16","value":2128}')
+            broker.publish(root+'Ignored/Topic', 'xx')
+            for i in range(50):
+                await asyncio.sleep(0.02)
+                if received:
+                    break
+
+            await client.disconnect()
+            await listener.disconnect()
+            await asyncio.wait([task, listening], timeout=1)
+            await broker.stop()
+            return (b.devices, received)
+
+        with self.assertLogs("bridge", "ERROR"):
+            (devices, received) = asyncio.run(run())
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(devices[1].sValue, "21.28;0.00;0;0.00;0")
+        self.assertEqual(received, [("out/00158D0002786756", {"Unit": 1, "nvalue": 0, "svalue": "21.28;0.00;0;0.00;0", "Battery": 255, "RSSI": 100})])
+
+    def testReconnect(self):
+        import argparse
+        import asyncio
+        import json
+        import bridge
+        import mqtt
+
+        received = []
+
+        async def run():
+            broker = mqtt.Broker()
+            port = await broker.start()
+            publish = broker.publish
+            def record(topic, payload):
+                if topic.startswith("out/"):
+                    received.append(json.loads(payload))
+                publish(topic, payload)
+            broker.publish = record
+            args = argparse.Namespace(host="127.0.0.1", port=port, tls=False, username=None, password=None,
+                                      topic="AqaraHub", out_topic="out", heartbeat=60)
+            task = asyncio.ensure_future(bridge._main(args))
+            root = 'AqaraHub/00158D0002786756/1/in/'
+            for value in (2128, 2200):
+                for i in range(50):
+                    await asyncio.sleep(0.02)
+                    if broker.clients and all(broker.clients.values()):
+                        break
+                broker.publish(root+'Basic/Report Attributes/ModelIdentifier', '{"type":"string","value":"lumi.weather"}')
+                broker.publish(root+'Temperature Measurement/Report Attributes/MeasuredValue', '{"type":"int16","value":%d}' % value)
+                await asyncio.sleep(0.1)
+                broker.dropClients()
+            task.cancel()
+            await asyncio.wait([task], timeout=1)
+            await broker.stop()
+
+        reconnectDelay = bridge.ReconnectDelay
+        bridge.ReconnectDelay = 0.05
+        try:
+            with self.assertLogs("bridge", "WARNING"):
+                asyncio.run(run())
+        finally:
+            bridge.ReconnectDelay = reconnectDelay
+        self.assertEqual([(r["Unit"], r["svalue"]) for r in received], [(1, "21.28;0.00;0;0.00;0"), (1, "22.00;0.00;0;0.00;0")])
+
+    def testPingTimeout(self):
+        import asyncio
+        import mqtt
+
+        async def run():
+            broker = mqtt.Broker()
+            broker.answerPings = False
+            port = await broker.start()
+            client = mqtt.Client()
+            await client.connect("127.0.0.1", port, "client")
+            # Keep alive is whole seconds on the wire, shorten it client side only
+            client.keepAlive = 0.1
+            await asyncio.wait_for(client.run(lambda t, p: None), 2)
+            await client.disconnect()
+            await broker.stop()
+
+        asyncio.run(run())
+
+    def testNoUnitLimit(self):
+        import mockdomoticz
+
+        devices = mockdomoticz.Devices()
+        model = '/1/in/Basic/Report Attributes/ModelIdentifier'
+        for i in range(adapter.MaxUnit + 5):
+            adapter.onData(devices, devices.createDevice, 'AqaraHub', 'AqaraHub/DEV%d' % i + model, '{"type":"string","value":"TH01"}')
+        self.assertEqual(len(devices), adapter.MaxUnit + 5)
+
+    def testTopicMatches(self):
+        import mqtt
+
+        self.assertTrue(mqtt.topicMatches("A/+/linkquality", "A/XX/linkquality"))
+        self.assertTrue(mqtt.topicMatches("A/#", "A/XX/1/in/Y"))
+        self.assertFalse(mqtt.topicMatches("A/+/linkquality", "A/XX/1/linkquality"))
+        self.assertFalse(mqtt.topicMatches("A/+", "A"))
+
+
 if __name__ == '__main__':
     unittest.main()